@@ -41,11 +41,19 @@ IS_PY3 = sys.version_info[0] == 3
 import traceback
 import os
 import re
+import codecs as _codecs
+import mmap as _mmap
+import tempfile as _tempfile
+import json as _json
+import array as _array
+import heapq as _heapq
+import hashlib as _hashlib
 from glob import glob as original_glob
 from types import ModuleType
 from functools import partial
 import inspect
 import time as _time
+import random as _random
 
 from locale import getpreferredencoding
 DEFAULT_ENCODING = getpreferredencoding() or "utf-8"
@@ -79,12 +87,37 @@ import fcntl
 import struct
 import resource
 from collections import deque
+from itertools import islice
 import logging
 import weakref
 
 
 logging_enabled = False
 
+# os.readv lets us read into a buffer that we reuse, instead of allocating a
+# new bytes object for every read.  it's only available in python >= 3.3
+HAS_READV = hasattr(os, "readv")
+
+# the bounds on how much we read from a process's stdout/stderr in one go.  see
+# StreamReader for how we pick between them
+MIN_READ_SIZE = 1024
+MAX_READ_SIZE = 256 * 1024
+
+# the typecode of the array that LineIndex keeps line offsets in.  "L" is
+# only 4 bytes on some platforms, which is too small for more than 4GB of
+# output, but "Q" is only in python 3.3+
+try: _array.array("Q")
+except ValueError: LINE_OFFSET_TYPE = "L"
+else: LINE_OFFSET_TYPE = "Q"
+
+# bytes.isascii lets us check if a chunk of output is text without decoding
+# it.  it's only available in python >= 3.7
+HAS_ISASCII = hasattr(bytes, "isascii")
+
+# multiprocessing.shared_memory, which SharedRingWriter and SharedRingReader
+# are built on, is only in python >= 3.8
+HAS_SHARED_MEMORY = sys.version_info >= (3, 8)
+
 
 if IS_PY3:
     raw_input = input
@@ -97,10 +130,17 @@ if IS_PY3:
 class ErrorReturnCode(Exception):
     truncate_cap = 750
 
-    def __init__(self, full_cmd, stdout, stderr):
+    def __init__(self, full_cmd, stdout, stderr, stdout_dropped=0,
+            stderr_dropped=0):
         self.full_cmd = full_cmd
         self.stdout = stdout
         self.stderr = stderr
+        
+        # how many bytes of output weren't kept, because of
+        # _internal_bytesize, so that you know stdout and stderr aren't
+        # everything
+        self.stdout_dropped = stdout_dropped
+        self.stderr_dropped = stderr_dropped
 
 
         if self.stdout is None: tstdout = "<redirected>"
@@ -109,6 +149,8 @@ class ErrorReturnCode(Exception):
             out_delta = len(self.stdout) - len(tstdout)
             if out_delta: 
                 tstdout += ("... (%d more, please see e.stdout)" % out_delta).encode()
+            if stdout_dropped:
+                tstdout += ("\n  (%d bytes not kept)" % stdout_dropped).encode()
             
         if self.stderr is None: tstderr = "<redirected>"
         else:
@@ -116,6 +158,8 @@ class ErrorReturnCode(Exception):
             err_delta = len(self.stderr) - len(tstderr)
             if err_delta: 
                 tstderr += ("... (%d more, please see e.stderr)" % err_delta).encode()
+            if stderr_dropped:
+                tstderr += ("\n  (%d bytes not kept)" % stderr_dropped).encode()
 
         msg = "\n\n  RAN: %r\n\n  STDOUT:\n%s\n\n  STDERR:\n%s" %\
             (full_cmd, tstdout.decode(DEFAULT_ENCODING), tstderr.decode(DEFAULT_ENCODING))
@@ -138,6 +182,31 @@ SIGNALS_THAT_SHOULD_THROW_EXCEPTION = (
 # https://github.com/amoffat/sh/issues/97#issuecomment-10610629
 class CommandNotFound(AttributeError): pass
 
+
+# raised when a process's stdout or stderr outgrows "internal_bytesize" and
+# "internal_overflow" is set to "error"
+class BufferOverflow(Exception):
+    def __init__(self, full_cmd, name, maxsize, dropped):
+        self.full_cmd = full_cmd
+        self.name = name
+        self.maxsize = maxsize
+        self.dropped = dropped
+        
+        msg = "\n\n  RAN: %r\n\n  %s exceeded its internal buffer size of \
+%d bytes (%d bytes dropped)" % (full_cmd, name.upper(), maxsize, dropped)
+        super(BufferOverflow, self).__init__(msg)
+        
+
+# a record in a stream with an output format (like _out_format="json") that
+# couldn't be parsed.  iterating raises it when we get to the bad record, and
+# callbacks are given it in place of the record.  the raw record is in .record
+class RecordParseError(ValueError):
+    def __init__(self, record, exc):
+        self.record = record
+        self.exc = exc
+        super(RecordParseError, self).__init__("couldn't parse %r: %s" % (
+            record[:200], exc))
+
 rc_exc_regex = re.compile("(ErrorReturnCode|SignalException)_(\d+)")
 rc_exc_cache = {}
 
@@ -198,6 +267,186 @@ def glob(arg):
     return original_glob(arg) or arg
 
 
+# whether a file object's write() writes exactly what it's given to its
+# fileno(), so that we can skip it and use os.write.  that isn't true of file
+# objects that wrap another one, like gzip and bz2 files, or that encode what
+# they're given, like text files, even though their fileno() works, so we
+# only trust the types that we know
+def is_raw_file(handler):
+    import io
+    types = (io.FileIO, io.BufferedWriter, io.BufferedRandom)
+    if not IS_PY3: types += (file,)
+    return type(handler) in types
+
+
+# a place to redirect output to that isn't a callback or something we can
+# write to is the path of a file to write to
+def open_redirect(target):
+    if target \
+        and not callable(target) \
+        and not hasattr(target, "write") \
+        and not isinstance(target, (cStringIO, StringIO)):
+        
+        target = open(str(target), "wb")
+    return target
+
+
+# if every ascii character encodes to the same single byte in this encoding,
+# then any chunk of all ascii bytes is valid text in it
+def is_ascii_compatible(encoding):
+    chars = "".join(chr(i) for i in range(128))
+    try: return chars.encode(encoding) == chars.encode("ascii")
+    except (UnicodeError, LookupError): return False
+
+
+# this is for determining how many arguments an _out or _err callback takes,
+# not counting "self" if the callback is a method or an object with a __call__
+# method.  a callback takes the data, and optionally the process's stdin
+# queue, and optionally the process itself
+def get_callback_num_args(fn):
+    if IS_PY3: getargspec = inspect.getfullargspec
+    else: getargspec = inspect.getargspec
+    
+    implied_arg = 0
+    if inspect.ismethod(fn):
+        implied_arg = 1
+        num_args = len(getargspec(fn).args)
+    
+    elif inspect.isfunction(fn):
+        num_args = len(getargspec(fn).args)
+        
+    # is an object instance with __call__ method
+    else:
+        implied_arg = 1
+        num_args = len(getargspec(fn.__call__).args)
+        
+    return num_args - implied_arg
+
+
+# numpy is optional, and slow to import, so we only import it once something
+# actually wants it
+def get_numpy():
+    try: import numpy
+    except ImportError: return None
+    return numpy
+
+
+# splits delimited output, like from ps or df, into a list of columns, each a
+# list of the bytes fields in it.  sep is like str.split's, where None means
+# any run of whitespace.  if every line has ncols fields (by default, as many
+# as the first line has), we can split all of the data in one go, and every
+# ncols'th field is in the same column, so we never make a string per line.
+# to know that they do, we split on a marker at the end of every line as
+# well, and check that it's always where it should be.  if it isn't, we split
+# line by line, with the last column getting the rest of its line, which is
+# what you want for something like ps's COMMAND column
+def split_columns(data, sep=None, ncols=None):
+    newline = "\n".encode()
+    marker = "\0".encode()
+    if sep is not None and not isinstance(sep, bytes): sep = sep.encode()
+    
+    data = data.rstrip(newline)
+    if not data: return [[] for i in range(ncols or 0)]
+    
+    if ncols is None:
+        end = data.find(newline)
+        if end == -1: end = len(data)
+        ncols = len(data[:end].split(sep))
+    
+    if marker not in data:
+        nlines = data.count(newline) + 1
+        if sep is None: fields = data.replace(newline, " \0 ".encode()).split()
+        else: fields = data.replace(newline, sep + marker + sep).split(sep)
+        
+        step = ncols + 1
+        if len(fields) == nlines * step - 1 and \
+                fields[ncols::step].count(marker) == nlines - 1:
+            return [fields[i::step] for i in range(ncols)]
+    
+    columns = [[] for i in range(ncols)]
+    for line in data.split(newline):
+        if sep is None and not line.strip(): continue
+        fields = line.split(sep, ncols - 1)
+        fields.extend(["".encode()] * (ncols - len(fields)))
+        for column, field in zip(columns, fields): column.append(field)
+    return columns
+
+
+# memoryview.cast is only in python 3.3+, so before that, we need numpy
+def view_as_array(view, dtype):
+    numpy = get_numpy()
+    if numpy: return numpy.frombuffer(view, dtype)
+    if not hasattr(view, "cast"):
+        raise RuntimeError("without numpy, arrays of output need python 3.3+")
+    return view.cast(dtype)
+
+
+# turns a column of bytes fields into text, or into an array of dtype.  dtype
+# is a typecode that the array module understands, like "l" or "d", or, if
+# numpy is installed, anything numpy.dtype understands, and we give you a
+# numpy array instead
+def convert_column(fields, dtype, encoding, decode_errors):
+    if dtype is None:
+        return [field.decode(encoding, decode_errors) for field in fields]
+    
+    numpy = get_numpy()
+    if numpy: return numpy.array(fields, dtype=bytes).astype(dtype)
+    
+    if dtype in ("f", "d"): convert = float
+    else: convert = int
+    return _array.array(dtype, [convert(field) for field in fields])
+
+
+# memoryviews can only be made read-only in python 3.8+, so before that, the
+# views we give out of our bytearrays are writable
+def readonly_view(view):
+    try: return view.toreadonly()
+    except AttributeError: return view
+
+# a copy of a bytearray from start on.  on python 3, slicing a memoryview of
+# it means we only copy once, but on python 2, bytes() of a memoryview is its
+# repr, and there are no memoryviews at all on 2.6
+def bytes_from(buffer, start=0):
+    if IS_PY3: return bytes(memoryview(buffer)[start:])
+    return str(buffer[start:])
+
+
+# these split an input into shards of about shard_size bytes that each end at
+# the end of a line, for Command.map_shards().  a file's shards are ranges of
+# it, which are each read from the file as they're fed to a process, so that
+# we never hold a whole shard in memory
+def file_shards(path, shard_size):
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        start = 0
+        while start < size:
+            # the shard ends after the first newline at or after where it
+            # would end if we didn't care about lines
+            f.seek(start + shard_size - 1)
+            f.readline()
+            end = min(f.tell(), size)
+            yield read_file_range(path, start, end)
+            start = end
+            
+def read_file_range(path, start, end, bufsize=64 * 1024):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while start < end:
+            chunk = f.read(min(bufsize, end - start))
+            if not chunk: break
+            start += len(chunk)
+            yield chunk
+
+# a stream can't be read from in more than one place, so its shards are read
+# into memory, one at a time, as they're needed
+def stream_shards(stream, shard_size):
+    while True:
+        shard = stream.read(shard_size)
+        if not shard: break
+        if shard[-1:] not in ("\n", "\n".encode()): shard += stream.readline()
+        yield [shard]
+
+
 
 class Logger(object):
     def __init__(self, name, context=None):
@@ -245,6 +494,23 @@ class RunningCommand(object):
         # processed.  but we don't want to raise multiple exceptions, only
         # one (if any at all)
         self._handled_exit_code = False
+        
+        # our decoded stdout, which we only have to decode once, because by
+        # the time we can read stdout, we've waited for the process to end
+        self._unicode = None
+        
+        # our LineIndex of stdout, see _get_line_index()
+        self._line_index = None
+        
+        # the chunks we've taken off of our pipe queue, but haven't yet
+        # handed out while iterating
+        self._iter_chunks = deque()
+        
+        # whether our iterator has been closed (see close()), and what closes
+        # it if we're garbage collected first (see IterCloser).  if another
+        # command reads our output through _pipe_source(), we don't
+        self._closed = False
+        self._closer = None
 
         self.should_wait = True
         spawn_process = True
@@ -257,7 +523,11 @@ class RunningCommand(object):
             Command._prepend_stack.append(self)
             
 
-        if callable(call_args["out"]) or callable(call_args["err"]):
+        redirects = []
+        for target in (call_args["out"], call_args["err"]):
+            if isinstance(target, (list, tuple)): redirects.extend(target)
+            else: redirects.append(target)
+        if any(callable(target) for target in redirects):
             self.should_wait = False
             
         if call_args["piped"] or call_args["iter"] or call_args["iter_noblock"]:
@@ -272,8 +542,7 @@ class RunningCommand(object):
         
         
         # set up which stream should write to the pipe
-        # TODO, make pipe None by default and limit the size of the Queue
-        # in oproc.OProc
+        # TODO, make pipe None by default
         pipe = STDOUT
         if call_args["iter"] == "out" or call_args["iter"] is True: pipe = STDOUT
         elif call_args["iter"] == "err": pipe = STDERR
@@ -281,11 +550,20 @@ class RunningCommand(object):
         if call_args["iter_noblock"] == "out" or call_args["iter_noblock"] is True: pipe = STDOUT
         elif call_args["iter_noblock"] == "err": pipe = STDERR
         
+        # if our output is being spilled to disk, we don't also want to hold
+        # all of it in the pipe queue, unless something is going to be
+        # consuming that queue while we run.  anything that gets our output
+        # piped to it afterwards reads it back from the spill file instead
+        if call_args["internal_spill"] is not None and not (call_args["piped"]
+                or call_args["iter"] or call_args["iter_noblock"]):
+            pipe = None
+        
         
         if spawn_process:
             self.log.debug("starting process")
             self.process = OProc(cmd, stdin, stdout, stderr, 
                 self.call_args, pipe=pipe)
+            if self._iterating(): self._closer = IterCloser(self)
             
             if self.should_wait:
                 self.wait()
@@ -301,12 +579,23 @@ class RunningCommand(object):
         if self._handled_exit_code: return
         self._handled_exit_code = True
         
+        error = getattr(self.process._output_thread, "error", None)
+        if error is not None: raise error
+        
+        for name in ("stdout", "stderr"):
+            buffer = getattr(self.process, "_" + name)
+            if buffer.overflow == "error" and buffer.dropped:
+                raise BufferOverflow(" ".join(self.cmd), name,
+                    buffer.maxsize, buffer.dropped)
+        
         if code not in self.call_args["ok_code"] and \
         (code > 0 or -code in SIGNALS_THAT_SHOULD_THROW_EXCEPTION):
             raise get_rc_exc(code)(
                 " ".join(self.cmd),
                 self.process.stdout,
-                self.process.stderr
+                self.process.stderr,
+                self.process._stdout.dropped,
+                self.process._stderr.dropped
             )
                 
                 
@@ -321,6 +610,116 @@ class RunningCommand(object):
         self.wait()
         return self.process.stderr
     
+    # these give you a memoryview of the output we've stored, without
+    # joining it into a new bytes object if we can help it.  for large
+    # binary output that you want to process in place
+    def stdout_view(self):
+        self.wait()
+        return self.process._stdout.view()
+    
+    def stderr_view(self):
+        self.wait()
+        return self.process._stderr.view()
+    
+    # these let you get at the lines of stdout, without decoding (or even
+    # splitting) all of it.  line(i) is the i'th line, decoded, without its
+    # newline, and lines() is a sequence of every line, which only decodes
+    # the lines that you index or slice
+    def len_lines(self):
+        return len(self._get_line_index())
+    
+    def line(self, i):
+        return self._line(i, self.stdout)
+    
+    # getting stdout isn't always free (compressed output is decompressed
+    # every time), so when we want more than one line, we get it just once,
+    # and pass it in as data
+    def _line(self, i, data):
+        start, end = self._get_line_index().span(i)
+        return self._decode_line(data[start:end])
+    
+    def lines(self):
+        return LineSequence(self)
+    
+    def _get_line_index(self):
+        self.wait()
+        if self._line_index is not None: return self._line_index
+        
+        # the index we built while the process ran is only good if its
+        # offsets are still offsets into stdout, that is, if nothing was
+        # dropped from the front of it
+        index = self.process._stdout_index
+        if index is None or self.process._stdout.dropped:
+            index = LineIndex.from_data(self.process.stdout)
+        self._line_index = index
+        return index
+    
+    def _decode_line(self, line):
+        if not self.call_args["decode"]: return line
+        return line.decode(self.call_args["encoding"],
+            self.call_args["decode_errors"])
+    
+    # with a list of _out or _err targets, the exceptions that stopped any of
+    # them from getting the rest of the output, as (target, exception) tuples
+    @property
+    def sink_errors(self):
+        self.wait()
+        errors = list(self.process._stdout_stream.sink_errors)
+        if self.process._stderr_stream:
+            errors.extend(self.process._stderr_stream.sink_errors)
+        return errors
+    
+    # the hex digests of stdout and stderr, if we were asked to hash them
+    # with _out_digest and _err_digest, and how many bytes of each the
+    # process wrote.  none of these depend on the output being stored
+    @property
+    def stdout_digest(self):
+        return self._stream_digest(self.process._stdout_stream)
+    
+    @property
+    def stderr_digest(self):
+        return self._stream_digest(self.process._stderr_stream)
+    
+    @property
+    def stdout_size(self):
+        self.wait()
+        return self.process._stdout_stream.size
+    
+    @property
+    def stderr_size(self):
+        self.wait()
+        if not self.process._stderr_stream: return 0
+        return self.process._stderr_stream.size
+    
+    def _stream_digest(self, stream):
+        self.wait()
+        if not stream or stream.digest is None: return None
+        return stream.digest.hexdigest()
+    
+    # with _compress, how many bytes stdout and stderr take up compressed.
+    # otherwise None
+    @property
+    def stdout_compressed_size(self):
+        return self._compressed_size(self.process._stdout)
+    
+    @property
+    def stderr_compressed_size(self):
+        return self._compressed_size(self.process._stderr)
+    
+    def _compressed_size(self, buffer):
+        self.wait()
+        if not isinstance(buffer, CompressedBuffer): return None
+        with buffer._lock: buffer._finish_member()
+        return buffer.compressed_size
+    
+    # stdout_view as a numpy array of dtype, or, without numpy, the view cast
+    # to a struct format character, like "i" or "d".  neither copies anything
+    def stdout_array(self, dtype="B"):
+        return view_as_array(self.stdout_view(), dtype)
+    
+    def stderr_array(self, dtype="B"):
+        return view_as_array(self.stderr_view(), dtype)
+    
     @property
     def exit_code(self):
         self.wait()
@@ -333,30 +732,194 @@ class RunningCommand(object):
     def __len__(self):
         return len(str(self))
     
+    # parses our stdout as a table, in bulk, and gives you a list of its
+    # columns, or a dict of its columns by name, if the first line is a
+    # header.  see split_columns and convert_column for what sep and dtypes
+    # do.  dtypes can be a list, one for each column, or a dict of dtypes by
+    # column name or index.  columns without a dtype are lists of strings
+    def to_columns(self, sep=None, dtypes=None, header=False):
+        data = self.stdout[:]
+        names = None
+        if header:
+            names, data = self._split_header(data, sep)
+        return self._make_columns(data, sep, dtypes, names)
+    
+    # like to_columns, but gives you the columns of however many lines are
+    # ready, each time around, while the process is still running.  run the
+    # process with _bg or _iter, or this will only get a single batch, once
+    # it has finished.  that's also what you get if the output doesn't go
+    # through the pipe queue (with _no_pipe, or an _out callback without
+    # _tee), or it has already been iterated over
+    def iter_columns(self, sep=None, dtypes=None, header=False):
+        queue = self.process._pipe_queue
+        if queue is None:
+            yield self.to_columns(sep, dtypes, header)
+            return
+        
+        newline = "\n".encode()
+        names = None
+        pending = "".encode()
+        done = False
+        first = True
+        
+        while not done:
+            chunks = self._iter_chunks
+            self._iter_chunks = deque()
+            while not chunks:
+                try: chunks = queue.get_many(True, 0.1)
+                except Empty:
+                    # nothing is going to put the end of our output on the
+                    # queue, if it's still empty once the process is done
+                    if self.process.alive: continue
+                    self.process.wait()
+                    try: chunks = queue.get_many(False)
+                    except Empty:
+                        if first:
+                            yield self.to_columns(sep, dtypes, header)
+                            return
+                        chunks = deque([None])
+                    break
+            first = False
+                
+            if chunks[-1] is None:
+                chunks.pop()
+                done = True
+            
+            # we only parse whole lines, so anything after the last newline
+            # waits for the next batch, unless this is the last one
+            data = pending + "".encode().join(chunks)
+            end = len(data)
+            if not done: end = data.rfind(newline) + 1
+            data, pending = data[:end], data[end:]
+            
+            if header and names is None:
+                if newline not in data and not done:
+                    pending = data + pending
+                    continue
+                names, data = self._split_header(data, sep)
+            
+            if data.strip(): yield self._make_columns(data, sep, dtypes, names)
+            
+        self.wait()
+        
+    def _split_header(self, data, sep):
+        if sep is not None and not isinstance(sep, bytes): sep = sep.encode()
+        end = data.find("\n".encode())
+        if end == -1: end = len(data)
+        
+        names = [field.decode(self.call_args["encoding"],
+            self.call_args["decode_errors"]) for field in data[:end].split(sep)]
+        return names, data[end + 1:]
+        
+    def _make_columns(self, data, sep, dtypes, names):
+        columns = split_columns(data, sep, names and len(names))
+        
+        if dtypes is None: dtypes = {}
+        elif not isinstance(dtypes, dict): dtypes = dict(enumerate(dtypes))
+        
+        for i, column in enumerate(columns):
+            dtype = dtypes.get(i)
+            if names and names[i] in dtypes: dtype = dtypes[names[i]]
+            columns[i] = convert_column(column, dtype, self.call_args["encoding"],
+                self.call_args["decode_errors"])
+        
+        if names: return dict(zip(names, columns))
+        return columns
+    
     def __enter__(self):
         # we don't actually do anything here because anything that should
         # have been done would have been done in the Command.__call__ call.
         # essentially all that has to happen is the comand be pushed on
-        # the prepend stack.
-        pass
+        # the prepend stack.  we return ourselves so that an iterating
+        # command can be used as "with sh.find(_iter=True) as lines:"
+        return self
     
     def __iter__(self):
+        # we have no pipe to iterate over, so our output went to the spill
+        # file, and we stream our lines back out of that
+        if self.process and self.process._pipe_queue is None:
+            return self._iter_spilled()
         return self
     
+    def _iter_spilled(self):
+        self.wait()
+        data = self.process._stdout.getvalue()
+        
+        start = 0
+        while start < len(data):
+            end = data.find("\n".encode(), start) + 1
+            if not end: end = len(data)
+            
+            chunk = data[start:end]
+            start = end
+            yield self._decode_chunk(chunk)
+            
+    # this is what a command that we're piped into reads its stdin from
+    def _pipe_source(self):
+        if self._closer: self._closer.cancel()
+        if self.process._pipe_queue is not None: return self.process._pipe_queue
+        return self._iter_spilled_chunks()
+    
+    def _iter_spilled_chunks(self):
+        # we're running in some other command's input thread, so we don't
+        # want to raise our exit code exception here
+        self.process.wait()
+        for chunk in self.process._stdout: yield chunk
+    
     def next(self):
-        # we do this because if get blocks, we can't catch a KeyboardInterrupt
-        # so the slight timeout allows for that.
-        while True:
-            try: chunk = self.process._pipe_queue.get(False, .001)
-            except Empty:
-                if self.call_args["iter_noblock"]: return errno.EWOULDBLOCK
-            else:
-                if chunk is None:
-                    self.wait()
-                    raise StopIteration()
-                try: return chunk.decode(self.call_args["encoding"],
-                    self.call_args["decode_errors"])
-                except UnicodeDecodeError: return chunk
+        if self._closed: raise StopIteration()
+        
+        # we take everything that's on the pipe queue at once, and hand it
+        # out one chunk at a time from here, so that we only go through the
+        # queue's lock once per batch
+        if not self._iter_chunks:
+            # we do this because if get blocks, we can't catch a
+            # KeyboardInterrupt so the slight timeout allows for that.
+            while True:
+                try:
+                    self._iter_chunks = self.process._pipe_queue.get_many(
+                        not self.call_args["iter_noblock"], 0.1)
+                    break
+                except Empty:
+                    if self.call_args["iter_noblock"]: return errno.EWOULDBLOCK
+        
+        if self.call_args["iter_batch"]: return self._next_batch()
+                    
+        chunk = self._iter_chunks.popleft()
+        if chunk is None:
+            self.wait()
+            raise StopIteration()
+        return self._decode_chunk(chunk)
+    
+    # with _iter_batch, we hand out as many chunks as we have, up to the
+    # batch size, as a list.  the end of our output, or a record that didn't
+    # parse, ends a batch early, and is left on _iter_chunks for the next call
+    # to deal with
+    def _next_batch(self):
+        chunks = self._iter_chunks
+        batch = []
+        
+        for i in range(min(self.call_args["iter_batch"], len(chunks))):
+            if chunks[0] is None: break
+            if batch and isinstance(chunks[0], RecordParseError): break
+            batch.append(self._decode_chunk(chunks.popleft()))
+            
+        if not batch:
+            self.wait()
+            raise StopIteration()
+        return batch
+    
+    # the chunks we hand out while iterating are decoded, unless they aren't
+    # valid text, or we've been told not to decode at all.  parsed records
+    # are handed out as is, unless they failed to parse
+    def _decode_chunk(self, chunk):
+        if chunk is NULL_RECORD: return None
+        if isinstance(chunk, RecordParseError): raise chunk
+        if not isinstance(chunk, bytes) or not self.call_args["decode"]:
+            return chunk
+        try: return chunk.decode(self.call_args["encoding"],
+            self.call_args["decode_errors"])
+        except UnicodeDecodeError: return chunk
             
     # python 3
     __next__ = next
@@ -364,15 +927,41 @@ class RunningCommand(object):
     def __exit__(self, typ, value, traceback):
         if self.call_args["with"] and Command._prepend_stack:
             Command._prepend_stack.pop()
+        if self._iterating(): self.close()
+        
+    # this is for when you're done iterating over our output before we're
+    # done writing it, like by breaking out of a for loop.  nothing is going
+    # to read the rest of it, so we stop keeping it, and signal the process
+    # with _iter_close_signal, so that it (usually) stops, instead of running
+    # to the end for nothing.  however the process exits after that, we
+    # don't raise an exception for it
+    def close(self):
+        if self._closed or not self.process: return
+        self._closed = True
+        self._handled_exit_code = True
+        self._iter_chunks = deque()
+        if self._closer: self._closer.cancel()
+        self.process.abandon_pipe(self.call_args["iter_close_signal"])
+        
+    def _iterating(self):
+        return bool(self.process and (self.call_args["iter"]
+            or self.call_args["iter_noblock"]))
    
     def __str__(self):
         if IS_PY3: return self.__unicode__()
         else: return unicode(self).encode(self.call_args["encoding"])
         
     def __unicode__(self):
-        if self.process and self.stdout:
-            return self.stdout.decode(self.call_args["encoding"],
-                self.call_args["decode_errors"])
+        if self._unicode is not None: return self._unicode
+        
+        stdout = None
+        if self.process: stdout = self.stdout
+        if stdout:
+            # we use codecs.decode because stdout isn't necessarily bytes, it
+            # may be an mmap of a spill file
+            self._unicode = _codecs.decode(stdout,
+                self.call_args["encoding"], self.call_args["decode_errors"])
+            return self._unicode
         return ""
 
     def __eq__(self, other):
@@ -408,6 +997,34 @@ class RunningCommand(object):
 
 
 
+# an iterator that's garbage collected before it's finished is as good as
+# closed, so this does what RunningCommand.close() does to its process, once
+# the command is collected.  it's not a RunningCommand.__del__, because on
+# python 2, a reference cycle with a __del__ in it is never collected, and
+# a callback that refers to its own command makes one.  so we only hold a
+# weak reference to the command, and live holds on to us until then
+class IterCloser(object):
+    live = set()
+    
+    def __init__(self, command):
+        self.process = command.process
+        self.signal = command.call_args["iter_close_signal"]
+        self.ref = weakref.ref(command, self._collected)
+        IterCloser.live.add(self)
+        
+    # the command was closed or piped somewhere, so there's nothing to do
+    def cancel(self):
+        IterCloser.live.discard(self)
+        
+    def _collected(self, ref):
+        if self not in IterCloser.live: return
+        IterCloser.live.discard(self)
+        try: self.process.abandon_pipe(self.signal)
+        except Exception: pass
+
+
+
+
 class Command(object):
     _prepend_stack = []
     
@@ -440,10 +1057,62 @@ class Command(object):
         # be "internal_bufsize" CHUNKS of 1024 bytes
         "internal_bufsize": 3 * 1024**2,
         
+        # if this is set, the output buffers instead hold at most this many
+        # *BYTES*, with no per-chunk overhead, and "internal_bufsize" is
+        # ignored.  "internal_overflow" says what's kept once it's full:
+        #   "tail"        the most recent output (like the chunk buffers)
+        #   "head"        the earliest output
+        #   "error"       the earliest output, and BufferOverflow is raised
+        #                 when the process is waited on
+        #   "tail_lines"  the most recent whole lines
+        #   "sample"      a random sample of whole lines, in order
+        # the byte modes keep a single block of memory.  the line modes don't
+        # count a last line that hasn't ended yet
+        "internal_bytesize": None,
+        "internal_overflow": "tail",
+        
+        # if this is set, once more than this many bytes of stdout or stderr
+        # have been stored, they're moved to an anonymous temporary file, and
+        # everything after that is appended to the file.  .stdout and .stderr
+        # then give you a read-only mmap of that file, instead of bytes
+        "internal_spill": None,
+        
+        # "zlib" or "lzma", to compress stdout and stderr as we store them.
+        # they're decompressed every time .stdout or .stderr is used, so
+        # this is for output that you want to keep around, but mostly won't
+        # look at
+        "compress": None,
+        
         "env": None,
         "piped": None,
+        
+        # this is how many bytes of output can be waiting in a process's pipe
+        # queue (the queue that _piped and _iter consumers read from) before
+        # we stop reading from the process.  when that happens, the process
+        # blocks when it next writes, until the consumer catches up.  None
+        # means the pipe queue is unbounded.  it's only bounded for commands
+        # with _piped, _iter, _iter_noblock or _bg, since otherwise nothing
+        # ever consumes it.  NOTICE a _bg command's queue still has to be
+        # consumed (by piping it), or the process may never finish
+        "pipe_bytesize": None,
+        # if the pipe queue is full, also SIGSTOP the process, and SIGCONT it
+        # once the queue is half empty.  for processes that write to a TTY
+        "pipe_stop": False,
+
         "iter": None,
         "iter_noblock": None,
+        
+        # the signal we send a process whose output we were iterating over,
+        # when the iterator is closed (or garbage collected) before the
+        # process is done.  SIGPIPE is closer to what a shell pipeline does,
+        # but processes we launch inherit python's ignoring of SIGPIPE,
+        # unless they set it back up themselves.  None sends nothing
+        "iter_close_signal": signal.SIGTERM,
+        
+        # an IOEngine that reads the process's output, instead of the process
+        # getting an output thread of its own.  Command.map() uses one for
+        # all of the processes it runs
+        "io_engine": None,
         "ok_code": 0,
         "cwd": None,
         "long_sep": "=",
@@ -456,6 +1125,43 @@ class Command(object):
         "encoding": DEFAULT_ENCODING,
         "decode_errors": "strict",
         
+        # if this is False, the chunks handed to callbacks and iterators are
+        # always bytes, and we never try to decode them first.  line
+        # buffering also always splits on newlines, because without decoding,
+        # we don't check if the output is binary
+        "decode": True,
+        
+        # with this set to "json", stdout is parsed as newline delimited json
+        # as we read it, and callbacks and iteration are given the parsed
+        # objects instead of lines.  blank lines are skipped.  .stdout is
+        # still the raw output
+        "out_format": None,
+        "err_format": None,
+        
+        # if this is set, iterating gives you lists of up to this many chunks
+        # (or records) at a time, instead of one at a time
+        "iter_batch": None,
+        
+        # if this is True, we keep an index of where each line of stdout
+        # starts as we store it, for RunningCommand.line() and friends.
+        # without it, the index is built from stdout the first time it's
+        # needed
+        "line_index": False,
+        
+        # a hashlib algorithm name, like "sha256", or a hash constructor, to
+        # hash stdout (or stderr) with as we read it.  the hex digest is
+        # RunningCommand.stdout_digest.  with _no_out, nothing is stored, and
+        # this costs nothing but the hashing
+        "out_digest": None,
+        "err_digest": None,
+        
+        # a regex, or a function that takes a chunk (a line, if the output
+        # is line buffered) as bytes, and returns whether we should keep it.
+        # chunks that don't match are thrown away before they're stored,
+        # piped, or handed to a callback
+        "out_filter": None,
+        "err_filter": None,
+        
         # how long the process should run before it is auto-killed
         "timeout": 0,
         
@@ -480,6 +1186,11 @@ class Command(object):
         #("fg", "bg", "Command can't be run in the foreground and background"),
         ("err", "err_to_out", "Stderr is already being redirected"),
         ("piped", "iter", "You cannot iterate when this command is being piped"),
+        ("internal_spill", "internal_bytesize", "Spilled output is not size limited"),
+        ("compress", "internal_spill", "Spilled output can't be compressed"),
+        ("compress", "internal_bytesize", "Compressed output is not size limited"),
+        ("piped", "out_format", "Parsed records can't be piped to another command"),
+        ("piped", "err_format", "Parsed records can't be piped to another command"),
     )
 
 
@@ -521,7 +1232,7 @@ class Command(object):
         getattr = partial(object.__getattribute__, self)
 
         if name.startswith("_"): return getattr(name)
-        if name == "bake": return getattr("bake")
+        if name in ("bake", "map", "map_shards"): return getattr(name)
         if name.endswith("_"): name = name[:-1]
         
         return getattr("bake")(name)
@@ -630,6 +1341,98 @@ If you're using glob.glob(), please use sh.glob() instead." % self.path, stackle
         sep = pruned_call_args.get("long_sep", self._call_args["long_sep"])
         fn._partial_baked_args.extend(self._compile_args(args, kwargs, sep))
         return fn
+    
+    
+    # runs the command once for each item, with the item as its arguments (a
+    # list or tuple item is several arguments), and at most "concurrency" of
+    # them running at a time, one per cpu by default.  it yields each
+    # finished RunningCommand, or the exception that it raised, in the order
+    # of the items if "ordered", otherwise in the order that they finish.
+    # keyword arguments are passed to every call, like _ok_code.  all of the
+    # processes' output is read by a single IOEngine, so that mapping over
+    # thousands of items doesn't mean thousands of threads
+    def map(self, iterable, concurrency=None, ordered=True, **kwargs):
+        calls = (((item,), kwargs) for item in iterable)
+        return self._map(calls, concurrency, ordered)
+    
+    # splits source, a file path or a stream (anything with a read method),
+    # into shards of whole lines, and runs the command once for each shard,
+    # with the shard as its stdin.  it yields the same things as map(), so
+    # with "ordered", joining their output together puts it back in order.
+    # by default, a file is split into a shard per process that we run at
+    # once, and a stream into shards of 16MB
+    def map_shards(self, source, shard_size=None, concurrency=None,
+            ordered=True, **kwargs):
+        if concurrency is None:
+            from multiprocessing import cpu_count
+            concurrency = cpu_count()
+            
+        if hasattr(source, "read"):
+            shards = stream_shards(source, shard_size or 16 * 1024**2)
+        else:
+            if shard_size is None:
+                size = os.path.getsize(source)
+                shard_size = max(1, -(-size // concurrency))
+            shards = file_shards(source, shard_size)
+        
+        calls = (((), dict(kwargs, _in=shard)) for shard in shards)
+        return self._map(calls, concurrency, ordered)
+    
+    # calls is an iterable of (args, kwargs) to call the command with
+    def _map(self, calls, concurrency, ordered):
+        if concurrency is None:
+            from multiprocessing import cpu_count
+            concurrency = cpu_count()
+        
+        finished = Queue()
+        engine = IOEngine(finished.put)
+        calls = enumerate(calls)
+        running = {}
+        results = {}
+        next_index = 0
+        
+        try:
+            while True:
+                while len(running) < concurrency:
+                    try: i, (args, kwargs) = next(calls)
+                    except StopIteration: break
+                    
+                    for name in ("_bg", "_io_engine"):
+                        if name in kwargs:
+                            raise TypeError("%s can't be passed to map(), it "
+                                "always runs commands in the background" % name)
+                    
+                    cmd = self(*args, _bg=True, _io_engine=engine, **kwargs)
+                    running[cmd.process] = (i, cmd)
+                    
+                if not running: break
+                
+                # like RunningCommand.next, we don't block on get() forever,
+                # so that a KeyboardInterrupt can get through
+                while True:
+                    try: proc = finished.get(True, 0.1)
+                    except Empty: continue
+                    break
+                
+                i, cmd = running.pop(proc)
+                try: result = cmd.wait()
+                except Exception as e: result = e
+                
+                if not ordered:
+                    yield result
+                    continue
+                
+                # we hold on to results that finish early, until all of the
+                # ones before them have finished too
+                results[i] = result
+                while next_index in results:
+                    yield results.pop(next_index)
+                    next_index += 1
+        
+        # if we're stopped early, we don't leave what's running behind us
+        finally:
+            for i, cmd in running.values(): cmd.process.terminate()
+            engine.stop()
        
     def __str__(self):
         if IS_PY3: return self.__unicode__()
@@ -691,7 +1494,7 @@ If you're using glob.glob(), please use sh.glob() instead." % self.path, stackle
                 # in the background, then this command should run in the
                 # background as well
                 if first_arg.call_args["bg"]: call_args["bg"] = True
-                stdin = first_arg.process._pipe_queue
+                stdin = first_arg._pipe_source()
                 
             else:
                 args.insert(0, first_arg)
@@ -706,21 +1509,18 @@ If you're using glob.glob(), please use sh.glob() instead." % self.path, stackle
         cmd.extend(final_args)
 
 
-        # stdout redirection
+        # stdout and stderr redirection.  either can be a list of places to
+        # send the output to, each of which is treated the same way as if it
+        # were the only one
         stdout = call_args["out"]
-        if stdout \
-            and not callable(stdout) \
-            and not hasattr(stdout, "write") \
-            and not isinstance(stdout, (cStringIO, StringIO)):
-            
-            stdout = open(str(stdout), "wb")
+        if isinstance(stdout, (list, tuple)):
+            stdout = [open_redirect(target) for target in stdout]
+        else: stdout = open_redirect(stdout)
         
-
-        # stderr redirection
         stderr = call_args["err"]
-        if stderr and not callable(stderr) and not hasattr(stderr, "write") \
-            and not isinstance(stderr, (cStringIO, StringIO)):
-            stderr = open(str(stderr), "wb")
+        if isinstance(stderr, (list, tuple)):
+            stderr = [open_redirect(target) for target in stderr]
+        else: stderr = open_redirect(stderr)
             
 
         return RunningCommand(cmd, call_args, stdin, stdout, stderr)
@@ -747,6 +1547,19 @@ class OProc(object):
         self.call_args = call_args
 
         self._single_tty = self.call_args["tty_in"] and self.call_args["tty_out"]
+        
+        # we only need a channel to the process's stdin if we've been given
+        # some input, if stdin is a TTY (because then the process is probably
+        # interactive), or if one of our callbacks wants to write to stdin.
+        # otherwise, the process gets /dev/null for stdin, and we don't start
+        # an input thread at all
+        handlers = []
+        for handler in (stdout, stderr):
+            if isinstance(handler, (list, tuple)): handlers.extend(handler)
+            else: handlers.append(handler)
+        self._has_stdin = stdin is not None or self.call_args["tty_in"] or \
+            any(callable(handler) and get_callback_num_args(handler) > 1
+                for handler in handlers)
 
         # this logic is a little convoluted, but basically this top-level
         # if/else is for consolidating input and output TTYs into a single
@@ -765,8 +1578,11 @@ class OProc(object):
         else:
             if self.call_args["tty_in"]:
                 self._slave_stdin_fd, self._stdin_fd = pty.openpty()
-            else:
+            elif self._has_stdin:
                 self._slave_stdin_fd, self._stdin_fd = os.pipe()
+            else:
+                self._slave_stdin_fd = os.open(os.devnull, os.O_RDONLY)
+                self._stdin_fd = None
             
             # tty_out is usually the default
             if self.call_args["tty_out"]:
@@ -809,7 +1625,7 @@ class OProc(object):
                 tty.setraw(self._stdout_fd)
                 
                 
-            os.close(self._stdin_fd)
+            if self._stdin_fd is not None: os.close(self._stdin_fd)
             if not self._single_tty:
                 os.close(self._stdout_fd)
                 if stderr is not STDOUT: os.close(self._stderr_fd)                
@@ -857,18 +1673,34 @@ class OProc(object):
             self.cmd = cmd
             self.exit_code = None
             
-            self.stdin = stdin or Queue()
-            self._pipe_queue = Queue()
+            self.stdin = None
+            if self._has_stdin: self.stdin = stdin or Queue()
+            self._pipe_queue = None
+            if pipe is not None:
+                # a foreground command's pipe queue is never consumed, so if
+                # we bounded it, we'd stop reading and the process would
+                # never finish
+                ca = self.call_args
+                bytesize = None
+                if ca["piped"] or ca["iter"] or ca["iter_noblock"] or ca["bg"]:
+                    bytesize = ca["pipe_bytesize"]
+                self._pipe_queue = PipeQueue(bytesize)
+                
+            # whether we've SIGSTOPped the process, see _throttle()
+            self._stopped = False
         
             # this is used to prevent a race condition when we're waiting for
             # a process to end, and the OProc's internal threads are also checking
             # for the processes's end
             self._wait_lock = threading.Lock()
         
-            # these are for aggregating the stdout and stderr.  we use a deque
-            # because we don't want to overflow
-            self._stdout = deque(maxlen=self.call_args["internal_bufsize"])
-            self._stderr = deque(maxlen=self.call_args["internal_bufsize"])
+            # these are for aggregating the stdout and stderr.  they're
+            # bounded, because we don't want to overflow
+            self._stdout = get_output_buffer(self.call_args)
+            self._stderr = get_output_buffer(self.call_args)
+            
+            self._stdout_index = None
+            if self.call_args["line_index"]: self._stdout_index = LineIndex()
             
             if self.call_args["tty_in"]: self.setwinsize(self._stdin_fd)
             
@@ -891,8 +1723,10 @@ class OProc(object):
 
             # this represents the connection from a Queue object (or whatever
             # we're using to feed STDIN) to the process's STDIN fd
-            self._stdin_stream = StreamWriter("stdin", self, self._stdin_fd,
-                self.stdin, self.call_args["in_bufsize"])
+            self._stdin_stream = None
+            if self._has_stdin:
+                self._stdin_stream = StreamWriter("stdin", self, self._stdin_fd,
+                    self.stdin, self.call_args["in_bufsize"])
                            
                         
             stdout_pipe = None   
@@ -907,7 +1741,10 @@ class OProc(object):
                 (self.call_args["tee"] in (True, "out") or stdout is None)
             self._stdout_stream = StreamReader("stdout", self, self._stdout_fd, stdout,
                 self._stdout, self.call_args["out_bufsize"], stdout_pipe,
-                save_data=save_stdout)
+                save_data=save_stdout, record_format=self.call_args["out_format"],
+                line_index=self._stdout_index,
+                digest=self.call_args["out_digest"],
+                chunk_filter=self.call_args["out_filter"])
                 
                 
             if stderr is STDOUT or self._single_tty: self._stderr_stream = None 
@@ -920,11 +1757,25 @@ class OProc(object):
                     (self.call_args["tee"] in ("err",) or stderr is None)
                 self._stderr_stream = StreamReader("stderr", self, self._stderr_fd, stderr,
                     self._stderr, self.call_args["err_bufsize"], stderr_pipe,
-                    save_data=save_stderr)
+                    save_data=save_stderr, record_format=self.call_args["err_format"],
+                    digest=self.call_args["err_digest"],
+                    chunk_filter=self.call_args["err_filter"])
             
             # start the main io threads
-            self._input_thread = self._start_thread(self.input_thread, self._stdin_stream)
-            self._output_thread = self._start_thread(self.output_thread, self._stdout_stream, self._stderr_stream)
+            self._input_thread = None
+            if self._stdin_stream:
+                self._input_thread = self._start_thread(self.input_thread,
+                    self._stdin_stream)
+            
+            # _output_thread is anything we can join() once all of our output
+            # has been read
+            engine = self.call_args["io_engine"]
+            if engine is None:
+                self._output_thread = self._start_thread(self.output_thread,
+                    self._stdout_stream, self._stderr_stream)
+            else:
+                self._output_thread = engine.register(self,
+                    self._stdout_stream, self._stderr_stream)
             
             
     def __repr__(self):
@@ -951,7 +1802,8 @@ class OProc(object):
         return thrd
     
     def in_bufsize(self, buf):
-        self._stdin_stream.stream_bufferer.change_buffering(buf)
+        if self._stdin_stream:
+            self._stdin_stream.stream_bufferer.change_buffering(buf)
                 
     def out_bufsize(self, buf):
         self._stdout_stream.stream_bufferer.change_buffering(buf)
@@ -982,7 +1834,21 @@ class OProc(object):
             errors.append(stderr)
 
         while readers:
-            outputs, inputs, err = select.select(readers, [], errors, 0.1)
+            # a reader whose pipe queue is full doesn't get read from, until
+            # whatever is consuming that queue catches up.  this means the
+            # os pipe fills up, and the process blocks on writing to it.  we
+            # poll more often while that's happening, so that we notice
+            # quickly when the queue has room again
+            ready = [r for r in readers if not r.throttled()]
+            timeout = 0.1
+            if len(ready) != len(readers): timeout = 0.01
+            self._throttle(len(ready) != len(readers))
+            
+            if ready:
+                outputs, inputs, err = select.select(ready, [], ready, timeout)
+            else:
+                _time.sleep(timeout)
+                outputs, err = [], []
 
             # stdout and stderr
             for stream in outputs:
@@ -1013,24 +1879,62 @@ class OProc(object):
         # running, and closing the fd will cause some operation to
         # fail.  this is less complex than wrapping all the ops
         # in the above loop with out-of-band fd-close exceptions
+        self._throttle(False)
         while self.alive: _time.sleep(0.001)
         if stdout: stdout.close()
         if stderr: stderr.close()
+        
+        
+    # if "pipe_stop" is set, we don't only stop reading from the process when
+    # its pipe queue is full, we also SIGSTOP it, and SIGCONT it once the
+    # queue is drained.  this is for processes writing to a TTY, which don't
+    # always stop when the TTY fills up
+    def _throttle(self, throttled):
+        if not self.call_args["pipe_stop"]: return
+        
+        if throttled and not self._stopped:
+            self.log.debug("pipe queue is full, stopping process")
+            self.signal(signal.SIGSTOP)
+            self._stopped = True
+            
+        elif not throttled and self._stopped and self._pipe_queue.drained():
+            self.log.debug("pipe queue has drained, continuing process")
+            self._stopped = False
+            self.signal(signal.SIGCONT)
 
 
+    # whoever was consuming our pipe queue has gone away, so we stop keeping
+    # the output that goes to it, throw away what's on it, and signal the
+    # process, so that it isn't kept running for nothing
+    def abandon_pipe(self, sig):
+        for stream in (self._stdout_stream, self._stderr_stream):
+            if stream and stream.pipe_queue is not None: stream.save_data = False
+            
+        if self._pipe_queue is not None:
+            try: self._pipe_queue.get_many(False)
+            except Empty: pass
+            
+        if sig and self.alive: self.signal(sig)
+        
+
     @property
     def stdout(self):
-        return "".encode(self.call_args["encoding"]).join(self._stdout)
+        return self._stdout.getvalue()
     
     @property
     def stderr(self):
-        return "".encode(self.call_args["encoding"]).join(self._stderr)
+        return self._stderr.getvalue()
     
     
     def signal(self, sig):
         self.log.debug("sending signal %d", sig)
         try: os.kill(self.pid, sig)
         except OSError: pass
+        
+        # a stopped process won't act on most signals until it's continued
+        if self._stopped and sig not in (signal.SIGSTOP, signal.SIGCONT):
+            self._stopped = False
+            self.signal(signal.SIGCONT)
 
     def kill(self):
         self.log.debug("killing")
@@ -1098,7 +2002,7 @@ class OProc(object):
             else:
                 self.log.debug("exit code already set (%d), no need to wait", self.exit_code)
             
-            self._input_thread.join()
+            if self._input_thread: self._input_thread.join()
             self._output_thread.join()
             
             OProc._procs_to_cleanup.discard(self)
@@ -1108,6 +2012,156 @@ class OProc(object):
 
 
 
+# this reads the output of many processes from one thread, instead of each of
+# them having an output thread.  it's the same loop as OProc.output_thread,
+# but over the streams of every process registered with it.  once a process
+# has exited and its streams are closed, on_done is called with it.  if
+# reading a process's output raises an exception (say, its _out callback
+# does), we stop reading it and kill it, and the exception is raised from
+# its RunningCommand.wait(), instead of taking every other process down
+class IOEngine(object):
+    def __init__(self, on_done=None):
+        self.on_done = on_done
+        self.lock = threading.Lock()
+        
+        # the process that each of our readers belongs to, and each process's
+        # readers that aren't done yet.  a process with no readers left is
+        # waiting to exit
+        self.readers = {}
+        self.procs = {}
+        self.finished = {}
+        self.stopping = False
+        self.closed = False
+        
+        # we select() on this too, so that register() and stop() can wake us
+        # up, instead of waiting for select() to time out.  it's non-blocking
+        # so that waking us up never waits, since once there's anything on
+        # it at all, we're going to wake up anyways
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        fl = fcntl.fcntl(self._wakeup_write, fcntl.F_GETFL)
+        fcntl.fcntl(self._wakeup_write, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        self._thread = OProc._start_thread(self._run)
+        
+    def register(self, proc, stdout, stderr):
+        task = EngineTask(threading.Event())
+        with self.lock:
+            self.procs[proc] = []
+            self.finished[proc] = (task, stdout, stderr)
+            for stream in (stdout, stderr):
+                if stream is not None:
+                    self.procs[proc].append(stream)
+                    self.readers[stream] = proc
+            self._wakeup()
+        return task
+    
+    # once every registered process is done, the thread exits
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            self._wakeup()
+    
+    # this is called with the lock held, so that the thread can't close the
+    # pipe while we're writing to it
+    def _wakeup(self):
+        if self.closed: return
+        try: os.write(self._wakeup_write, b"x")
+        except OSError: pass
+        
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.stopping and not self.procs:
+                    self.closed = True
+                    os.close(self._wakeup_read)
+                    os.close(self._wakeup_write)
+                    break
+                procs = list(self.procs.items())
+                
+            ready = []
+            throttled = exiting = False
+            for proc, readers in procs:
+                proc_ready = [r for r in readers if not r.throttled()]
+                proc._throttle(len(proc_ready) != len(readers))
+                throttled = throttled or len(proc_ready) != len(readers)
+                exiting = exiting or not readers
+                ready.extend(proc_ready)
+            
+            # see OProc.output_thread.  processes that are done being read
+            # from are about to exit, so we poll them aggressively
+            timeout = 0.1
+            if throttled: timeout = 0.01
+            if exiting: timeout = 0.001
+            
+            outputs, inputs, err = select.select(ready + [self._wakeup_read],
+                [], [], timeout)
+            
+            for stream in outputs:
+                if stream is self._wakeup_read:
+                    os.read(self._wakeup_read, 1024)
+                    continue
+                
+                # its process failed earlier in this round
+                if stream not in self.readers: continue
+                
+                try: done = stream.read()
+                except Exception as e:
+                    self._fail(self.readers[stream], e)
+                    continue
+                
+                if done:
+                    with self.lock:
+                        self.procs[self.readers.pop(stream)].remove(stream)
+            
+            now = _time.time()
+            for proc, readers in procs:
+                if proc.call_args["timeout"] and \
+                        now - proc.started > proc.call_args["timeout"]:
+                    proc.kill()
+                    
+                if not readers and not proc.alive: self._finish(proc)
+                
+    # the other stream of a failed process may still be in this round's
+    # select() results, so we only take it out of our readers, and _finish
+    # closes it once the process has been killed and has exited
+    def _fail(self, proc, error):
+        with self.lock:
+            task = self.finished[proc][0]
+            if task.error is None: task.error = error
+            for stream in self.procs[proc]: del self.readers[stream]
+            self.procs[proc] = []
+        
+        if proc.alive: proc.kill()
+        
+    def _finish(self, proc):
+        with self.lock:
+            del self.procs[proc]
+            task, stdout, stderr = self.finished.pop(proc)
+        
+        proc._throttle(False)
+        for stream in (stdout, stderr):
+            if stream is None: continue
+            # closing flushes the stream's sinks, which can raise too
+            try: stream.close()
+            except Exception as e:
+                if task.error is None: task.error = e
+        
+        task.done.set()
+        if self.on_done: self.on_done(proc)
+        
+
+# what OProc has as its _output_thread, when an IOEngine is reading its output.
+# error is the exception that reading its output raised, if any
+class EngineTask(object):
+    def __init__(self, done):
+        self.done = done
+        self.error = None
+        
+    def join(self):
+        self.done.wait()
+
+
+
+
 class DoneReadingStdin(Exception): pass
 class NoStdinData(Exception): pass
 
@@ -1132,10 +2186,16 @@ class StreamWriter(object):
         # determine buffering for reading from the input we set for stdin
         if bufsize == 1: self.bufsize = 1024
         elif bufsize == 0: self.bufsize = 1
+        elif not isinstance(bufsize, int): self.bufsize = 1024
         else: self.bufsize = bufsize
             
         
-        if isinstance(stdin, Queue):
+        if isinstance(stdin, PipeQueue):
+            log_msg = "pipe queue"
+            self._pipe_done = False
+            self.get_chunk = self.get_pipe_queue_chunk
+            
+        elif isinstance(stdin, Queue):
             log_msg = "queue"
             self.get_chunk = self.get_queue_chunk
             
@@ -1178,6 +2238,20 @@ class StreamWriter(object):
         if chunk is None: raise DoneReadingStdin
         return chunk
         
+    # we're being piped another process's output, so we take everything that
+    # it has put on its pipe queue at once, and write it in one go
+    def get_pipe_queue_chunk(self):
+        if self._pipe_done: raise DoneReadingStdin
+        
+        try: chunks = self.stdin.get_many(True, 0.01)
+        except Empty: raise NoStdinData
+        
+        if chunks[-1] is None:
+            self._pipe_done = True
+            chunks.pop()
+            if not chunks: raise DoneReadingStdin
+        return "".encode().join(chunks)
+        
     def get_callable_chunk(self):
         try: return self.stdin()
         except: raise DoneReadingStdin
@@ -1246,14 +2320,28 @@ class StreamWriter(object):
 
 class StreamReader(object):
     def __init__(self, name, process, stream, handler, buffer, bufsize,
-            pipe_queue=None, save_data=True):
+            pipe_queue=None, save_data=True, record_format=None, line_index=None,
+            digest=None, chunk_filter=None):
         self.name = name
         self.process = weakref.ref(process)
         self.stream = stream
         self.buffer = buffer
         self.save_data = save_data
+        self.line_index = line_index
+        
+        # how many bytes we've read, and a hash of them, if we were asked for
+        # one.  these are over everything the process wrote, whether or not
+        # we keep it
+        self.size = 0
+        self.digest = None
+        if digest is not None:
+            if callable(digest): self.digest = digest()
+            else: self.digest = _hashlib.new(digest)
+        
+        self.chunk_filter = get_chunk_filter(chunk_filter)
         self.encoding = process.call_args["encoding"]
         self.decode_errors = process.call_args["decode_errors"]
+        self.decode = process.call_args["decode"]
         
         self.pipe_queue = None
         if pipe_queue: self.pipe_queue = weakref.ref(pipe_queue)
@@ -1261,54 +2349,43 @@ class StreamReader(object):
         self.log = Logger("streamreader", repr(self))
         
         self.stream_bufferer = StreamBufferer(self.encoding, bufsize,
+            self.decode_errors, detect_binary=self.decode)
+        self.parse_record = get_record_parser(record_format, self.encoding,
             self.decode_errors)
         
-        # determine buffering
-        if bufsize == 1: self.bufsize = 1024
-        elif bufsize == 0: self.bufsize = 1 
-        else: self.bufsize = bufsize
-        
-        
-        # here we're determining the handler type by doing some basic checks
-        # on the handler object
+        # how much we read at a time has nothing to do with how we're
+        # buffering, because a read only ever returns what's available.  so
+        # we start small, and double our read size every time a read fills
+        # it, which means the process is writing faster than we're reading,
+        # up to MAX_READ_SIZE.  once our reads come back mostly empty again,
+        # we shrink back down, so that a process that only writes a little
+        # at a time doesn't have us holding on to a big buffer
+        #
+        # the exception is unbuffered output.  an unbuffered reader has
+        # always handed over its output one byte at a time, so we split what
+        # we read into bytes for it
+        self._split_bytes = bufsize == 0
+        self._small_reads = 0
+        self._read_buffer = None
+        self._set_read_size(MIN_READ_SIZE)
+        
+        
+        # where our output goes, besides our buffer and pipe queue.  that's
+        # the _out (or _err) special kwarg, which can also be a list of
+        # places to send it.  if it's a list, one of them failing doesn't
+        # stop the others from getting the output.  the failure is recorded
+        # in sink_errors instead
         self.handler = handler
-        if callable(handler): self.handler_type = "fn"
-        elif isinstance(handler, StringIO): self.handler_type = "stringio"
-        elif isinstance(handler, cStringIO):
-            self.handler_type = "cstringio"
-        elif hasattr(handler, "write"): self.handler_type = "fd"
-        else: self.handler_type = None
-        
-        
-        self.should_quit = False
-        
-        # here we choose how to call the callback, depending on how many
-        # arguments it takes.  the reason for this is to make it as easy as
-        # possible for people to use, without limiting them.  a new user will
-        # assume the callback takes 1 argument (the data).  as they get more
-        # advanced, they may want to terminate the process, or pass some stdin
-        # back, and will realize that they can pass a callback of more args
-        if self.handler_type == "fn":
-            implied_arg = 0
-            if inspect.ismethod(handler):
-                implied_arg = 1
-                num_args = len(inspect.getargspec(handler).args)
-            
-            else:
-                if inspect.isfunction(handler):
-                    num_args = len(inspect.getargspec(handler).args)
-                    
-                # is an object instance with __call__ method
-                else:
-                    implied_arg = 1
-                    num_args = len(inspect.getargspec(handler.__call__).args)
-                
-                
-            self.handler_args = ()
-            if num_args == implied_arg + 2:
-                self.handler_args = (self.process().stdin,)
-            elif num_args == implied_arg + 3:
-                self.handler_args = (self.process().stdin, self.process)
+        self.isolate_sinks = isinstance(handler, (list, tuple))
+        handlers = handler
+        if not self.isolate_sinks: handlers = [handler]
+        self.sinks = [OutputSink(self.process, h) for h in handlers
+            if h is not None]
+        self.sink_errors = []
+        
+        # we decode each chunk only once, however many sinks want it decoded
+        self.decode_for_sinks = any(sink.type == "stringio" or
+            sink.type == "fn" and self.decode for sink in self.sinks)
                 
 
     def fileno(self):
@@ -1316,29 +2393,208 @@ class StreamReader(object):
             
     def __repr__(self):
         return "<StreamReader %s for %r>" % (self.name, self.process())
+    
+    # whether we should hold off on reading, because whatever is consuming
+    # our pipe queue hasn't caught up yet
+    def throttled(self):
+        return self.save_data and self.pipe_queue is not None \
+            and self.pipe_queue().full()
+    
+    def _set_read_size(self, size):
+        self.read_size = size
+        
+        # we read into this one preallocated buffer, instead of letting
+        # os.read allocate a brand new bytes object for every read.  the
+        # bufferer is handed a view over the bytes that were read, and it
+        # only allocates the final chunks that it hands back to us.  we make
+        # a new buffer instead of resizing the old one, because a bytearray
+        # can't be resized while there's a view of it
+        if HAS_READV:
+            self._read_buffer = bytearray(size)
+            self._read_view = memoryview(self._read_buffer)
 
     def close(self):
         chunk = self.stream_bufferer.flush()
         self.log.debug("got chunk size %d to flush: %r",
             len(chunk), chunk[:30])
-        if chunk: self.write_chunk(chunk)
+        if chunk: self.write_chunks([chunk])
         
-        if self.handler_type == "fd" and hasattr(self.handler, "close"):
-            self.handler.flush()
+        for sink in self.sinks: sink.flush()
+        self.buffer.close()
         
         if self.pipe_queue and self.save_data: self.pipe_queue().put(None)
         try: os.close(self.stream)
         except OSError: pass
+        
+        
+    def write_chunks(self, chunks):
+        if self.chunk_filter is not None:
+            chunks = [chunk for chunk in chunks if self.chunk_filter(chunk)]
+            if not chunks: return
+            
+        # if we have an output format, each chunk is parsed into a record
+        # once, here, and it's the records that go to callbacks and the pipe
+        # queue.  the raw chunks are what we store
+        records = chunks
+        if self.parse_record:
+            records = [self.parse_record(chunk) for chunk in chunks]
+            
+        for chunk, record in zip(chunks, records):
+            self.write_chunk(chunk, record)
+        
+        # everything from one read goes onto the pipe queue in one go, so
+        # that we, and whatever is consuming the queue, only take its lock
+        # once per read, instead of once per chunk
+        if self.save_data and self.pipe_queue and chunks:
+            self.log.debug("putting %d chunks onto pipe", len(chunks))
+            size = None
+            if self.parse_record:
+                size = sum(len(chunk) for chunk in chunks)
+                
+                # None is the end of the pipe queue, so a record that is None
+                # (a json null) goes onto it as NULL_RECORD instead
+                records = [NULL_RECORD if r is None else r for r in records
+                    if r is not NO_RECORD]
+            self.pipe_queue().put_many(records, size)
 
 
-    def write_chunk(self, chunk):
+    def write_chunk(self, chunk, record):
         # in PY3, the chunk coming in will be bytes, so keep that in mind
         
-        if self.handler_type == "fn" and not self.should_quit:
-            # try to use the encoding first, if that doesn't work, send
-            # the bytes, because it might be binary
-            try: to_handler = chunk.decode(self.encoding, self.decode_errors)
-            except UnicodeDecodeError: to_handler = chunk
+        text = None
+        if self.decode_for_sinks:
+            try: text = chunk.decode(self.encoding, self.decode_errors)
+            except UnicodeDecodeError: pass
+        
+        for sink in self.sinks:
+            if not self.isolate_sinks:
+                sink.write(chunk, record, text)
+                continue
+            
+            if sink.failed: continue
+            try: sink.write(chunk, record, text)
+            except Exception as e:
+                self.log.exception("%r failed, not writing to it anymore",
+                    sink.handler)
+                sink.failed = True
+                self.sink_errors.append((sink.handler, e))
+            
+
+        if self.save_data:
+            self.buffer.append(chunk)
+            if self.line_index is not None: self.line_index.append(chunk)
+
+            
+    def read(self):
+        # if our pipe queue is bounded, we don't read much more than it has
+        # room for, so that it stays (more or less) within its bounds
+        size = self.read_size
+        if self.save_data and self.pipe_queue is not None:
+            room = self.pipe_queue().room()
+            if room is not None: size = min(size, max(room, MIN_READ_SIZE))
+        
+        # if we're PY3, we're reading bytes, otherwise we're reading
+        # str.  if we have readv, we're reading into our reusable buffer,
+        # and chunk is a memoryview over it, which is only valid until our
+        # next read
+        try:
+            if self._read_buffer is None:
+                chunk = os.read(self.stream, size)
+            else:
+                chunk = self._read_view[:os.readv(self.stream,
+                    (self._read_view[:size],))]
+        except OSError as e:
+            self.log.debug("got errno %d, done reading", e.errno)
+            return True
+        if not chunk:
+            self.log.debug("got no chunk, done reading")
+            return True
+                
+        self.log.debug("got chunk size %d: %r", len(chunk), bytes(chunk[:30]))
+        self._adapt_read_size(len(chunk))
+        
+        self.size += len(chunk)
+        if self.digest is not None: self.digest.update(chunk)
+        
+        chunks = self.stream_bufferer.process(chunk)
+        if self._split_bytes and self.stream_bufferer.type == 0:
+            chunks = [c[i:i+1] for c in chunks for i in range(len(c))]
+        self.write_chunks(chunks)
+        
+    def _adapt_read_size(self, size):
+        if size == self.read_size:
+            self._small_reads = 0
+            if size < MAX_READ_SIZE: self._set_read_size(size * 2)
+            
+        elif size <= self.read_size // 4 and self.read_size > MIN_READ_SIZE:
+            self._small_reads += 1
+            if self._small_reads >= 4:
+                self._small_reads = 0
+                self._set_read_size(self.read_size // 2)
+    
+
+
+
+# one of the places that a StreamReader sends its output to.  it can be a
+# callback, a StringIO (which gets text), or something with a write method,
+# which gets bytes
+class OutputSink(object):
+    def __init__(self, process, handler):
+        self.process = process
+        self.handler = handler
+        self.failed = False
+        self.should_quit = False
+        
+        call_args = process().call_args
+        self.encoding = call_args["encoding"]
+        self.decode_errors = call_args["decode_errors"]
+        self.decode = call_args["decode"]
+        
+        # here we're determining the handler type by doing some basic checks
+        # on the handler object
+        if callable(handler): self.type = "fn"
+        elif isinstance(handler, StringIO): self.type = "stringio"
+        elif isinstance(handler, cStringIO): self.type = "cstringio"
+        elif hasattr(handler, "write"): self.type = "fd"
+        else: self.type = None
+        
+        # if we're writing to a plain binary file, we write straight to its
+        # file descriptor with os.write, instead of going through the file
+        # object and its buffering.  we flush it first, so anything already
+        # written to it comes before our output
+        self.fd = None
+        if self.type == "fd" and is_raw_file(handler):
+            handler.flush()
+            self.fd = handler.fileno()
+        
+        # here we choose how to call the callback, depending on how many
+        # arguments it takes.  the reason for this is to make it as easy as
+        # possible for people to use, without limiting them.  a new user will
+        # assume the callback takes 1 argument (the data).  as they get more
+        # advanced, they may want to terminate the process, or pass some stdin
+        # back, and will realize that they can pass a callback of more args
+        if self.type == "fn":
+            num_args = get_callback_num_args(handler)
+                
+            self.handler_args = ()
+            if num_args == 2:
+                self.handler_args = (process().stdin,)
+            elif num_args == 3:
+                self.handler_args = (process().stdin, process)
+                
+    def __repr__(self):
+        return "<OutputSink %s %r>" % (self.type, self.handler)
+                
+    # "record" is what the chunk was parsed into, if we have an output
+    # format, and "text" is the chunk decoded, or None, if it couldn't be
+    def write(self, chunk, record, text):
+        if self.type == "fn" and not self.should_quit \
+                and record is not NO_RECORD:
+            # callbacks get text if they can, otherwise the bytes, because
+            # the output might be binary
+            to_handler = record
+            if record is chunk and self.decode and text is not None:
+                to_handler = text
             
             # this is really ugly, but we can't store self.process as one of
             # the handler args in self.handler_args, the reason being is that
@@ -1352,36 +2608,369 @@ class StreamReader(object):
                 handler_args = (self.handler_args[0], self.process())
             self.should_quit = self.handler(to_handler, *handler_args)
             
-        elif self.handler_type == "stringio":
-            self.handler.write(chunk.decode(self.encoding, self.decode_errors))
+        elif self.type == "stringio":
+            if text is None: text = chunk.decode(self.encoding, self.decode_errors)
+            self.handler.write(text)
+            
+        elif self.fd is not None:
+            while chunk: chunk = chunk[os.write(self.fd, chunk):]
 
-        elif self.handler_type in ("cstringio", "fd"):
+        elif self.type in ("cstringio", "fd"):
             self.handler.write(chunk)
             
+    def flush(self):
+        if self.type == "fd" and self.fd is None and hasattr(self.handler, "flush"):
+            self.handler.flush()
+    
+    
+    
+# a ring buffer in shared memory, that you can pass as _out (or _err) so
+# that other processes, like a multiprocessing pool, can read a command's
+# output from it without it being pickled.  the shared memory starts with a
+# header of 4 unsigned 64 bit ints, in native byte order:
+#
+#   capacity    the size of the ring, which comes right after the header
+#   write_pos   how many bytes have ever been written to the ring
+#   read_pos    how many bytes have ever been read from it
+#   closed      1 once the writer is done
+#
+# the positions only ever go up, and a position's offset into the ring is
+# the position modulo the capacity.  each chunk (a line, if the output is
+# line buffered) is written as a record, prefixed with its length as a 4 byte
+# unsigned int.  write_pos only moves once a record is completely written,
+# so a reader never sees half of one.  if the ring is full, write() waits for
+# readers to make room, which holds up the StreamReader, and so, the process.
+# if it waits longer than "timeout", or the writer is closed while it waits
+# (from another thread), the writer gives up: it closes, and every record
+# from then on is thrown away and counted in "dropped", so that the process
+# can still finish.  a record that's bigger than the whole ring is thrown
+# away and counted the same way.  we never raise from write(), because an
+# exception there stops the StreamReader, which hangs the process
+#
+# NOTICE on x86, a reader in another process sees our writes in the order we
+# made them, so it never sees write_pos move before the record it covers.
+# other cpus, like arm ones (apple silicon macs, for one), can reorder them,
+# so there, the writer and all of its readers need to share a lock (like a
+# multiprocessing.Lock).  the positions are then only read and set with it
+# held, and the lock orders everything written before it
+#
+# NOTICE we don't use struct.pack_into() for the positions.  it zeroes the
+# bytes it's about to pack into first, so a reader in another process could
+# see a position go back to 0.  instead, the header is a memoryview cast to
+# native unsigned 64 bit ints, and setting one of them copies it in one go
+class SharedRing(object):
+    header_size = 4 * 8
+    length = struct.Struct("I")
+    poll_interval = 0.0005
+    lock = None
+    
+    def _attach(self, name, create=False, size=0):
+        from multiprocessing import shared_memory
+        
+        if create:
+            self.shm = shared_memory.SharedMemory(name, create=True,
+                size=self.header_size + size)
+        else:
+            # on python 3.13+, we don't have the resource tracker keep track
+            # of shared memory that we didn't create.  before that, it tracks
+            # it, but for a reader in the writer's process, or a child of it
+            # (like a multiprocessing pool), that's the writer's tracker,
+            # which already knows about it
+            try: self.shm = shared_memory.SharedMemory(name, track=False)
+            except TypeError: self.shm = shared_memory.SharedMemory(name)
+            
+        self.positions = self.shm.buf[:self.header_size].cast("Q")
+        self.ring = self.shm.buf[self.header_size:]
+        
+    def _detach(self):
+        # the shared memory can't be closed while we still have views of it
+        self.positions.release()
+        self.ring.release()
+        self.shm.close()
+
+    # otherwise, the SharedMemory can't close itself when it's collected
+    def __del__(self):
+        if "ring" in self.__dict__:
+            self.positions.release()
+            self.ring.release()
 
-        if self.save_data:
-            self.buffer.append(chunk)
+    @property
+    def name(self):
+        return self.shm.name
+    
+    def _get_header(self):
+        return tuple(self.positions)
+    
+    def _get(self, field):
+        if self.lock is None: return self.positions[field]
+        with self.lock: return self.positions[field]
+        
+    def _set(self, field, value):
+        if self.lock is None: self.positions[field] = value
+        else:
+            with self.lock: self.positions[field] = value
+    
+    def _copy_in(self, pos, data):
+        offset = pos % self.capacity
+        first = min(len(data), self.capacity - offset)
+        self.ring[offset:offset + first] = data[:first]
+        if first < len(data): self.ring[:len(data) - first] = data[first:]
+        
+    def _copy_out(self, pos, size):
+        offset = pos % self.capacity
+        first = min(size, self.capacity - offset)
+        data = bytes(self.ring[offset:offset + first])
+        if first < size: data += bytes(self.ring[:size - first])
+        return data
+    
+    
+class SharedRingWriter(SharedRing):
+    def __init__(self, capacity=1024 * 1024, name=None, timeout=None,
+            lock=None):
+        self._attach(name, create=True, size=capacity)
+        self.capacity = capacity
+        self.positions[0] = capacity
+        self.write_pos = 0
+        self.timeout = timeout
+        self.lock = lock
+        self.closed = False
+        self.dropped = 0
+        
+    def __repr__(self):
+        return "<SharedRingWriter %r %d bytes>" % (self.name, self.capacity)
+        
+    def write(self, chunk):
+        size = self.length.size + len(chunk)
+        if size > self.capacity:
+            self.dropped += 1
+            return
+        
+        end = None
+        if self.timeout is not None: end = _time.time() + self.timeout
+        
+        while not self.closed and \
+                self.capacity - (self.write_pos - self._get(2)) < size:
+            if end is not None and _time.time() >= end:
+                self.close()
+                break
+            _time.sleep(self.poll_interval)
             
-            if self.pipe_queue:
-                self.log.debug("putting chunk onto pipe: %r", chunk[:30])
-                self.pipe_queue().put(chunk)
-
+        if self.closed:
+            self.dropped += 1
+            return
             
-    def read(self):
-        # if we're PY3, we're reading bytes, otherwise we're reading
-        # str
-        try: chunk = os.read(self.stream, self.bufsize)
-        except OSError as e:
-            self.log.debug("got errno %d, done reading", e.errno)
-            return True
-        if not chunk:
-            self.log.debug("got no chunk, done reading")
-            return True
-                
-        self.log.debug("got chunk size %d: %r", len(chunk), chunk[:30])
-        for chunk in self.stream_bufferer.process(chunk):
-            self.write_chunk(chunk)   
+        self._copy_in(self.write_pos, self.length.pack(len(chunk)))
+        self._copy_in(self.write_pos + self.length.size, chunk)
+        self.write_pos += size
+        self._set(1, self.write_pos)
+        
+    def flush(self):
+        pass
+        
+    # this tells the readers that there's nothing more coming, once they've
+    # read what's left.  the shared memory is still there until unlink()
+    def close(self):
+        self.closed = True
+        self._set(3, 1)
+    
+    def unlink(self):
+        self._detach()
+        self.shm.unlink()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, typ, value, traceback):
+        self.close()
+    
+    
+# attaches to a SharedRingWriter's ring by its name.  if more than one reader
+# reads from the same ring, they need to share a lock (like a
+# multiprocessing.Lock), so that each record goes to exactly one of them
+class SharedRingReader(SharedRing):
+    def __init__(self, name, lock=None):
+        self._attach(name)
+        self.capacity = self.positions[0]
+        self.lock = lock
+        
+    def __repr__(self):
+        return "<SharedRingReader %r>" % self.name
+    
+    # returns the next record, or None once the writer is closed and there
+    # are no records left.  if timeout passes with neither, raises Empty
+    def read(self, timeout=None):
+        end = None
+        if timeout is not None: end = _time.time() + timeout
+        
+        while True:
+            if self.lock is None: record = self._read_record()
+            else:
+                with self.lock: record = self._read_record()
+            if record is not False: return record
+            
+            if end is not None and _time.time() >= end: raise Empty
+            _time.sleep(self.poll_interval)
+    
+    # a record, None at the end, or False if there's nothing to read yet
+    def _read_record(self):
+        capacity, write_pos, read_pos, closed = self._get_header()
+        if read_pos == write_pos:
+            if closed:
+                # the writer may have written one last record between us
+                # reading the positions and the closed flag
+                if self.positions[1] == write_pos: return None
+            return False
+        
+        size = self.length.unpack(self._copy_out(read_pos, self.length.size))[0]
+        record = self._copy_out(read_pos + self.length.size, size)
+        self.positions[2] = read_pos + self.length.size + size
+        return record
+    
+    def __iter__(self):
+        while True:
+            record = self.read()
+            if record is None: break
+            yield record
+            
+    def close(self):
+        self._detach()
+    
+    
+    
+# this is the queue that chunks of a process's output are put on, for piping
+# into another process, or for iterating over.  it's like a Queue, except that
+# it's bounded by the number of bytes on it, rather than the number of
+# chunks.  and it's never put() that blocks when it's full, instead, the
+# StreamReader stops reading from the process until it isn't full
+class PipeQueue(object):
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.size = 0
+        self.queue = deque()
+        self.not_empty = threading.Condition(threading.Lock())
+        
+    def put(self, chunk):
+        self.put_many((chunk,))
+            
+    # "size" is how many bytes the chunks represent.  it's only needed if
+    # they aren't bytes themselves, like parsed records
+    def put_many(self, chunks, size=None):
+        if size is None:
+            size = sum(len(chunk) for chunk in chunks if chunk is not None)
+        with self.not_empty:
+            self.queue.extend(chunks)
+            self.size += size
+            self.not_empty.notify()
+            
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            self._wait(block, timeout)
+            chunk = self.queue.popleft()
+            
+            # we don't know how many bytes a parsed record came from, so we
+            # only settle up on those once we've been emptied
+            if not self.queue: self.size = 0
+            elif isinstance(chunk, bytes): self.size -= len(chunk)
+            return chunk
+        
+    # this gets everything that's on the queue at once, by swapping it out
+    # for an empty one.  so a consumer that can handle a batch of chunks only
+    # has to take our lock once per batch
+    def get_many(self, block=True, timeout=None):
+        with self.not_empty:
+            self._wait(block, timeout)
+            chunks = self.queue
+            self.queue = deque()
+            self.size = 0
+            return chunks
+        
+    def _wait(self, block, timeout):
+        if not self.queue and block:
+            if timeout is None:
+                while not self.queue: self.not_empty.wait()
+            else:
+                end = _time.time() + timeout
+                while not self.queue:
+                    remaining = end - _time.time()
+                    if remaining <= 0: break
+                    self.not_empty.wait(remaining)
+        
+        if not self.queue: raise Empty
+        
+    def empty(self):
+        return not self.queue
+    
+    def full(self):
+        return self.maxsize is not None and self.size >= self.maxsize
+    
+    def room(self):
+        if self.maxsize is None: return None
+        return max(self.maxsize - self.size, 0)
+    
+    # whether we've gotten far enough below our maxsize to start filling up
+    # again.  this is so a SIGSTOPped process isn't continued and stopped
+    # over and over again for every chunk
+    def drained(self):
+        return self.maxsize is None or self.size <= self.maxsize // 2
+    
     
+    
+
+# for the _out_filter and _err_filter special kwargs.  a regex is searched
+# for in each chunk, and a string is compiled into a bytes regex first.
+# anything else is a function that we call with each chunk
+def get_chunk_filter(chunk_filter):
+    if chunk_filter is None: return None
+    if isinstance(chunk_filter, (basestring, bytes)):
+        if not isinstance(chunk_filter, bytes):
+            chunk_filter = chunk_filter.encode(DEFAULT_ENCODING)
+        chunk_filter = re.compile(chunk_filter)
+    if hasattr(chunk_filter, "search"): return chunk_filter.search
+    return chunk_filter
+
+
+# returned by a record parser for a chunk that has no record in it, like a
+# blank line
+NO_RECORD = object()
+NULL_RECORD = object()
+
+# returns a function that parses one chunk of output (a line, for the formats
+# we have so far) into a record, for the _out_format and _err_format special
+# kwargs.  the parser is made once per stream, so that whatever it needs, like
+# the json decoder, is only set up once
+def get_record_parser(fmt, encoding, decode_errors):
+    if fmt is None: return None
+    
+    if fmt == "json":
+        decoder = _json.JSONDecoder()
+        
+        def parse_record(chunk):
+            if not chunk.strip(): return NO_RECORD
+            try: return decoder.decode(chunk.decode(encoding, decode_errors))
+            except ValueError as e: return RecordParseError(chunk, e)
+        
+        return parse_record
+    
+    raise ValueError("unknown output format %r" % fmt)
+
+
+
+# pass one of these as a buffering type (like _out_bufsize) to break a stream
+# up into records that each start with their length, packed as "fmt" (see the
+# struct module).  the default is a 4 byte big endian unsigned int.  like a
+# line includes its newline, each record includes its length prefix, so that
+# stdout, and anything we pipe the output to, gets exactly what the process
+# wrote.  use payload() to get a record without its prefix
+class LengthPrefixed(object):
+    def __init__(self, fmt=">I"):
+        self.header = struct.Struct(fmt)
+        
+    def __repr__(self):
+        return "<LengthPrefixed %r>" % self.header.format
+        
+    def payload(self, record):
+        return record[self.header.size:]
+
 
 
 
@@ -1393,16 +2982,27 @@ class StreamReader(object):
 # feed it as lines to be sent down the pipe
 class StreamBufferer(object):
     def __init__(self, encoding=DEFAULT_ENCODING, buffer_type=1,
-            decode_errors="strict"):
-        # 0 for unbuffered, 1 for line, everything else for that amount
-        self.type = buffer_type
-        self.buffer = []
-        self.n_buffer_count = 0
+            decode_errors="strict", detect_binary=True):
+        # 0 for unbuffered, 1 for line, any other number for that amount.  a
+        # string splits on that delimiter instead of a newline, and a
+        # LengthPrefixed splits into length prefixed records
         self.encoding = encoding
         self.decode_errors = decode_errors
+        self.type = self._normalize_type(buffer_type)
+        self.buffer = bytearray()
+        
+        # when line buffered, we check that what we're getting is really
+        # text, because if it's binary, matching on newlines doesn't make
+        # sense.  we use an incremental decoder for that, so that a multibyte
+        # character that is split across two reads doesn't look like binary.
+        # for encodings that ascii is a subset of, we can skip the decoder
+        # entirely for chunks that are all ascii, which is most of them
+        self.detect_binary = detect_binary
+        self._decoder = _codecs.getincrementaldecoder(encoding)(decode_errors)
+        self._ascii_fast_path = HAS_ISASCII and is_ascii_compatible(encoding)
         
         # this is for if we change buffering types.  if we change from line
-        # buffered to unbuffered, its very possible that our self.buffer list
+        # buffered to unbuffered, its very possible that our self.buffer
         # has data that was being saved up (while we searched for a newline).
         # we need to use that up, so we don't lose it
         self._use_up_buffer_first = False
@@ -1422,27 +3022,43 @@ class StreamBufferer(object):
         self.log.debug("got buffering lock for changing buffering")
         try:                
             if new_type == 0: self._use_up_buffer_first = True
+            if new_type == 1: self._decoder.reset()
                 
-            self.type = new_type
+            self.type = self._normalize_type(new_type)
         finally:
             self._buffering_lock.release()
             self.log.debug("released buffering lock for changing buffering")
             
         
+    # our delimiter has to be bytes, because that's what we're splitting
+    def _normalize_type(self, buffer_type):
+        if isinstance(buffer_type, basestring) and hasattr(buffer_type, "encode"):
+            buffer_type = buffer_type.encode(self.encoding)
+        if isinstance(buffer_type, bytes) and not buffer_type:
+            raise ValueError("Buffering delimiter can't be empty")
+        return buffer_type
+            
+            
     def process(self, chunk):
-        # MAKE SURE THAT THE INPUT IS PY3 BYTES
+        # MAKE SURE THAT THE INPUT IS PY3 BYTES, OR A MEMORYVIEW OVER BYTES
         # THE OUTPUT IS ALWAYS PY3 BYTES
+        #
+        # if we're given a memoryview, it's over a buffer that is going to be
+        # reused as soon as we return, so anything we hand back must be
+        # copied out of it with bytes().  anything we hold on to is copied
+        # into self.buffer, a bytearray, which is where we save up partial
+        # lines/chunks until we have enough to hand back
         
         # TODO, when we stop supporting 2.6, make this a with context
-        self.log.debug("acquiring buffering lock to process chunk (buffering: %d)", self.type)
+        self.log.debug("acquiring buffering lock to process chunk (buffering: %r)", self.type)
         self._buffering_lock.acquire()
-        self.log.debug("got buffering lock to process chunk (buffering: %d)", self.type)
+        self.log.debug("got buffering lock to process chunk (buffering: %r)", self.type)
         try:
             # we've encountered binary, permanently switch to N size buffering
             # since matching on newline doesn't make sense anymore
             if self.type == 1:
-                try: chunk.decode(self.encoding, self.decode_errors)
-                except:
+                chunk = bytes(chunk)
+                if self.detect_binary and not self._is_text(chunk):
                     self.log.debug("detected binary data, changing buffering")
                     self.change_buffering(1024)
                 
@@ -1450,63 +3066,131 @@ class StreamBufferer(object):
             if self.type == 0:
                 if self._use_up_buffer_first:
                     self._use_up_buffer_first = False
-                    to_write = self.buffer
-                    self.buffer = []
-                    to_write.append(chunk)
+                    to_write = []
+                    if self.buffer: to_write.append(bytes(self.buffer))
+                    self.buffer = bytearray()
+                    to_write.append(bytes(chunk))
                     return to_write
                 
-                return [chunk]
+                return [bytes(chunk)]
             
             # line buffered
             elif self.type == 1:
-                total_to_write = []
-                chunk = chunk.decode(self.encoding, self.decode_errors)
-                while True:
-                    newline = chunk.find("\n")
-                    if newline == -1: break
-                    
-                    chunk_to_write = chunk[:newline+1]
-                    if self.buffer:
-                        # this is ugly, but it's designed to take the existing
-                        # bytes buffer, join it together, tack on our latest
-                        # chunk, then convert the whole thing to a string.
-                        # it's necessary, i'm sure.  read the whole block to
-                        # see why.
-                        chunk_to_write = "".encode(self.encoding).join(self.buffer) \
-                            + chunk_to_write.encode(self.encoding)
-                        chunk_to_write = chunk_to_write.decode(self.encoding)
-                        
-                        self.buffer = []
-                        self.n_buffer_count = 0
-                    
-                    chunk = chunk[newline+1:]
-                    total_to_write.append(chunk_to_write.encode(self.encoding))
-                         
-                if chunk:
-                    self.buffer.append(chunk.encode(self.encoding))
-                    self.n_buffer_count += len(chunk)
-                return total_to_write
+                return self._split_delimited(chunk, "\n".encode())
+            
+            # buffered on some other delimiter
+            elif isinstance(self.type, bytes):
+                return self._split_delimited(bytes(chunk), self.type)
+            
+            elif isinstance(self.type, LengthPrefixed):
+                return self._split_length_prefixed(chunk)
               
             # N size buffered  
             else:
                 total_to_write = []
-                while True:
-                    overage = self.n_buffer_count + len(chunk) - self.type
-                    if overage >= 0:
-                        ret = "".encode(self.encoding).join(self.buffer) + chunk
-                        chunk_to_write = ret[:self.type]
-                        chunk = ret[self.type:]
-                        total_to_write.append(chunk_to_write)
-                        self.buffer = []
-                        self.n_buffer_count = 0
+                start = 0
+                
+                # top off whatever we have saved up from last time first
+                if self.buffer:
+                    needed = self.type - len(self.buffer)
+                    
+                    # our buffering may have been changed to something
+                    # smaller than what we've already saved up
+                    if needed <= 0:
+                        self.buffer += chunk
+                        chunk = bytes(self.buffer)
+                        self.buffer = bytearray()
+                        
+                    elif len(chunk) < needed:
+                        self.buffer += chunk
+                        return total_to_write
+                    
                     else:
-                        self.buffer.append(chunk)
-                        self.n_buffer_count += len(chunk)
-                        break
+                        self.buffer += chunk[:needed]
+                        total_to_write.append(bytes(self.buffer))
+                        self.buffer = bytearray()
+                        start = needed
+                    
+                # then slice full sized chunks directly out of what we got
+                while len(chunk) - start >= self.type:
+                    total_to_write.append(bytes(chunk[start:start+self.type]))
+                    start += self.type
+                    
+                if start < len(chunk): self.buffer += chunk[start:]
                 return total_to_write
         finally:
             self._buffering_lock.release()
-            self.log.debug("released buffering lock for processing chunk (buffering: %d)", self.type)
+            self.log.debug("released buffering lock for processing chunk (buffering: %r)", self.type)
+            
+
+    # this is one pass over the chunk: each record (and its delimiter) is
+    # sliced straight out of it, and only a record that started in a previous
+    # chunk has to be put together in self.buffer first
+    def _split_delimited(self, chunk, delimiter):
+        total_to_write = []
+        start = 0
+        
+        # a delimiter that's longer than a byte may have been split between
+        # the end of the last chunk and the start of this one
+        overlap = len(delimiter) - 1
+        if self.buffer and overlap:
+            tail = bytes(self.buffer[-overlap:])
+            end = (tail + chunk[:overlap]).find(delimiter)
+            if end != -1:
+                start = end + len(delimiter) - len(tail)
+                self.buffer += chunk[:start]
+                total_to_write.append(bytes(self.buffer))
+                self.buffer = bytearray()
+        
+        while True:
+            end = chunk.find(delimiter, start)
+            if end == -1: break
+            end += len(delimiter)
+            
+            if self.buffer:
+                self.buffer += chunk[start:end]
+                total_to_write.append(bytes(self.buffer))
+                self.buffer = bytearray()
+            else:
+                total_to_write.append(chunk[start:end])
+            start = end
+                 
+        if start < len(chunk): self.buffer += chunk[start:]
+        return total_to_write
+    
+    
+    def _split_length_prefixed(self, chunk):
+        total_to_write = []
+        header = self.type.header
+        
+        # we only have to join a record that started in a previous chunk
+        # onto this one, otherwise we unpack straight out of the chunk
+        data = chunk
+        if self.buffer:
+            self.buffer += chunk
+            data = self.buffer
+            
+        start = 0
+        while len(data) - start >= header.size:
+            end = start + header.size + header.unpack_from(data, start)[0]
+            if end > len(data): break
+            total_to_write.append(bytes(data[start:end]))
+            start = end
+            
+        if data is self.buffer: del self.buffer[:start]
+        elif start < len(data): self.buffer += data[start:]
+        return total_to_write
+    
+    
+    def _is_text(self, chunk):
+        # we can only skip the decoder if it isn't holding on to the start of
+        # a multibyte character from the last chunk
+        if self._ascii_fast_path and chunk.isascii() \
+            and not self._decoder.getstate()[0]: return True
+        
+        try: self._decoder.decode(chunk)
+        except UnicodeDecodeError: return False
+        return True
             
 
     def flush(self):
@@ -1514,8 +3198,8 @@ class StreamBufferer(object):
         self._buffering_lock.acquire()
         self.log.debug("got buffering lock for flushing buffer")
         try:
-            ret = "".encode(self.encoding).join(self.buffer)
-            self.buffer = []
+            ret = bytes(self.buffer)
+            self.buffer = bytearray()
             return ret
         finally:
             self._buffering_lock.release()
@@ -1525,6 +3209,501 @@ class StreamBufferer(object):
 
 
 
+# these are the internal buffers that a process's stdout and stderr are
+# aggregated into as it runs.  they all have an append() method for adding a
+# chunk, and a getvalue() method for getting back everything that was kept
+# as bytes.  "dropped" is how many bytes didn't fit
+#
+# getvalue() is called a lot (every str(), len(), ==, "in" etc on a
+# RunningCommand), so each buffer remembers the last value it built, and
+# only builds a new one if something was appended since.  if nothing was
+# dropped in the meantime either, the new value is just the old one plus
+# whatever was appended.  because getvalue() can be called from another
+# thread while the process is still running, appending and building the value
+# are done under a lock
+
+def get_output_buffer(call_args):
+    if call_args["compress"] is not None:
+        return CompressedBuffer(call_args["compress"])
+    if call_args["internal_spill"] is not None:
+        return SpillBuffer(call_args["internal_spill"])
+    if call_args["internal_bytesize"] is None:
+        return ChunkBuffer(call_args["internal_bufsize"])
+    
+    size = call_args["internal_bytesize"]
+    overflow = call_args["internal_overflow"]
+    if overflow == "tail_lines": return TailLinesBuffer(size)
+    if overflow == "sample": return SampleBuffer(size)
+    return ByteBuffer(size, overflow)
+
+
+# this keeps the last "maxlen" chunks, however big those chunks are
+class ChunkBuffer(object):
+    overflow = "tail"
+    
+    def __init__(self, maxlen):
+        self.maxsize = maxlen
+        self.chunks = deque(maxlen=maxlen)
+        self.dropped = 0
+        
+        self._lock = threading.Lock()
+        self._appended = 0
+        self._evicted = 0
+        self._value = "".encode()
+        self._value_appended = 0
+        self._value_evicted = 0
+        self.closed = False
+        
+    def append(self, chunk):
+        with self._lock:
+            if len(self.chunks) == self.maxsize:
+                if self.chunks: self.dropped += len(self.chunks[0])
+                else: self.dropped += len(chunk)
+                self._evicted += 1
+            self.chunks.append(chunk)
+            self._appended += 1
+        
+    def getvalue(self):
+        with self._lock:
+            new = self._appended - self._value_appended
+            if not new: return self._value
+            
+            # if none of the chunks in our last value have been pushed off
+            # the front since, we only have to tack the new ones on
+            if self._evicted == self._value_evicted:
+                new_chunks = list(islice(reversed(self.chunks), new))
+                new_chunks.reverse()
+                value = self._value + "".encode().join(new_chunks)
+            else:
+                value = "".encode().join(self.chunks)
+                
+            self._value = value
+            self._value_appended = self._appended
+            self._value_evicted = self._evicted
+            
+            # nothing is going to be appended to us anymore, so our chunks
+            # would only be a second copy of our value
+            if self.closed: self.chunks = deque([value], maxlen=self.maxsize)
+            return value
+        
+    # the process is done writing to us.  if we've already made a value,
+    # we bring it up to date, so that we don't hold on to it and the chunks
+    # both.  otherwise, we do that whenever a value is first asked for
+    def close(self):
+        with self._lock: self.closed = True
+        if self._value_appended: self.getvalue()
+        
+    # our chunks aren't contiguous, so this is a view of our (memoized)
+    # joined value
+    def view(self):
+        return memoryview(self.getvalue())
+    
+    
+# this keeps at most "maxsize" bytes in one contiguous bytearray, so there's
+# no overhead for each chunk.  when it's full, "overflow" decides whether we
+# keep the "tail" (most recent output) or the "head" (earliest output).
+# "error" keeps the head, and lets the RunningCommand raise BufferOverflow
+class ByteBuffer(object):
+    overflow_types = ("tail", "head", "error")
+    
+    def __init__(self, maxsize, overflow="tail"):
+        if overflow not in self.overflow_types:
+            raise ValueError("Unknown internal_overflow %r, must be one of %r" %
+                (overflow, self.overflow_types + ("tail_lines", "sample")))
+        
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.buffer = bytearray()
+        self.dropped = 0
+        
+        self._lock = threading.Lock()
+        self._evicted = 0
+        self._value = "".encode()
+        self._value_evicted = 0
+        self.closed = False
+        
+        # when we're keeping the tail, we don't shift the whole buffer down
+        # every time something falls off the front.  instead, we just move
+        # our start offset forward, and only compact the buffer once there's
+        # as much dead space as there is live data.  this keeps appending
+        # O(1) amortized, and the buffer under 2 * maxsize
+        self.start = 0
+        
+    def __len__(self):
+        if self.buffer is None: return len(self._value)
+        return len(self.buffer) - self.start
+        
+    def append(self, chunk):
+        with self._lock: self._append(chunk)
+        
+    def _append(self, chunk):
+        room = self.maxsize - len(self)
+        if len(chunk) <= room:
+            self.buffer += chunk
+            return
+        
+        if self.overflow == "tail":
+            if len(chunk) >= self.maxsize:
+                self.dropped += len(self) + len(chunk) - self.maxsize
+                self._evicted += len(self)
+                self.buffer = bytearray(chunk[len(chunk) - self.maxsize:])
+                self.start = 0
+                return
+            
+            self.buffer += chunk
+            excess = len(self) - self.maxsize
+            self.start += excess
+            self.dropped += excess
+            self._evicted += excess
+            
+            if self.start >= self.maxsize:
+                del self.buffer[:self.start]
+                self.start = 0
+                
+        else:
+            if room: self.buffer += chunk[:room]
+            self.dropped += len(chunk) - room
+        
+    def getvalue(self):
+        with self._lock:
+            if self.buffer is None: return self._value
+            
+            # if nothing has been pushed off the front since our last value,
+            # we only have to tack on what's been appended
+            if self._evicted == self._value_evicted:
+                if len(self) == len(self._value): return self._value
+                value = self._value + bytes_from(self.buffer,
+                    self.start + len(self._value))
+            else:
+                value = bytes_from(self.buffer, self.start)
+                
+            self._value = value
+            self._value_evicted = self._evicted
+            
+            # see ChunkBuffer.getvalue()
+            if self.closed: self.buffer = None
+            return value
+        
+    # see ChunkBuffer.close()
+    def close(self):
+        with self._lock: self.closed = True
+        if self._value: self.getvalue()
+        
+    # a read-only view straight into our buffer, without copying it.  NOTICE
+    # while the view exists, the buffer can't be resized, so this is only for
+    # once the process is done writing to us
+    def view(self):
+        with self._lock:
+            if self.buffer is None: return memoryview(self._value)
+            return readonly_view(memoryview(self.buffer)[self.start:])
+    
+    
+# this keeps output in memory until there's more than "threshold" bytes of it,
+# then moves it to an anonymous temporary file, so that we can capture any
+# amount of output without our memory usage growing.  once we've spilled,
+# getvalue() returns a read-only mmap of the file, which supports len(),
+# slicing, find() and decoding, like bytes does, but is paged in by the os
+# only as it's accessed
+class SpillBuffer(object):
+    overflow = None
+    maxsize = None
+    dropped = 0
+    
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.buffer = bytearray()
+        self.file = None
+        self._lock = threading.Lock()
+        self._mmap = None
+        self._value = "".encode()
+        self.closed = False
+        
+    def append(self, chunk):
+        with self._lock: self._append(chunk)
+        
+    def _append(self, chunk):
+        if self.file is not None:
+            self.file.write(chunk)
+            return
+        
+        self.buffer += chunk
+        if len(self.buffer) > self.threshold:
+            self.file = _tempfile.TemporaryFile()
+            self.file.write(self.buffer)
+            self.buffer = None
+            
+    def getvalue(self):
+        with self._lock:
+            if self.file is None:
+                if self.buffer is None: return self._value
+                if len(self.buffer) != len(self._value):
+                    self._value = bytes(self.buffer)
+                    
+                # see ChunkBuffer.getvalue()
+                if self.closed: self.buffer = None
+                return self._value
+            
+            # the file may still be growing, so we may need a bigger mapping
+            # than the last one we made
+            self.file.flush()
+            size = self.file.tell()
+            if self._mmap is None or len(self._mmap) != size:
+                self._mmap = _mmap.mmap(self.file.fileno(), size,
+                    access=_mmap.ACCESS_READ)
+            return self._mmap
+        
+    # see ChunkBuffer.close()
+    def close(self):
+        with self._lock: self.closed = True
+        if self._value: self.getvalue()
+        
+    # a read-only view of our buffer, or, once we've spilled, of the mmap of
+    # our file.  like ByteBuffer.view, this is for once the process is done
+    def view(self):
+        with self._lock:
+            if self.file is None:
+                if self.buffer is None: return memoryview(self._value)
+                return readonly_view(memoryview(self.buffer))
+                
+        # on python 2, an mmap doesn't support memoryviews, so we have to
+        # copy it
+        data = self.getvalue()
+        try: return memoryview(data)
+        except TypeError: return memoryview(data[:])
+    
+    def __iter__(self):
+        data = self.getvalue()
+        for i in range(0, len(data), 64 * 1024): yield data[i:i + 64 * 1024]
+    
+    
+# this compresses everything it's given as it's given it, and decompresses it
+# all again on getvalue().  a compressed stream can't be read until it's been
+# finished, so getvalue() finishes the one we're writing to, if there's
+# anything new in it, and starts a new one for anything after that.  each of
+# those is a "member", like gzip calls them
+class CompressedBuffer(object):
+    overflow = None
+    maxsize = None
+    dropped = 0
+    
+    def __init__(self, method):
+        if method == "zlib":
+            import zlib
+            self.compressor_class = zlib.compressobj
+            self.decompressor_class = zlib.decompressobj
+        elif method == "lzma":
+            import lzma
+            self.compressor_class = lzma.LZMACompressor
+            self.decompressor_class = lzma.LZMADecompressor
+        else: raise ValueError("Unknown compression %r" % method)
+        
+        self.method = method
+        self.members = []
+        self.compressor = None
+        self.size = 0
+        self.compressed_size = 0
+        self._lock = threading.Lock()
+        
+    def append(self, chunk):
+        with self._lock:
+            if self.compressor is None:
+                self.compressor = self.compressor_class()
+                self.members.append(bytearray())
+            self.members[-1] += self.compressor.compress(chunk)
+            self.size += len(chunk)
+            
+    def _finish_member(self):
+        if self.compressor is None: return
+        self.members[-1] += self.compressor.flush()
+        self.members[-1] = bytes(self.members[-1])
+        self.compressor = None
+        self.compressed_size = sum(len(member) for member in self.members)
+            
+    def getvalue(self):
+        with self._lock:
+            self._finish_member()
+            members = list(self.members)
+        return "".encode().join(self.decompressor_class().decompress(member)
+            for member in members)
+    
+    def close(self):
+        pass
+    
+    def view(self):
+        return memoryview(self.getvalue())
+    
+    
+# the base for buffers that keep some of the whole lines of the output, in at
+# most "maxsize" bytes.  the chunks we're given aren't necessarily lines, so
+# we split them, and hold on to a last line that hasn't ended yet until it
+# does.  that unfinished line is always part of our value, since it's the
+# last thing written, but it doesn't count towards "maxsize"
+class LinesBuffer(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.dropped = 0
+        self.dropped_lines = 0
+        self.partial = "".encode()
+        
+        self._lock = threading.Lock()
+        self._appended = 0
+        self._value = "".encode()
+        self._value_appended = 0
+        
+    def append(self, chunk):
+        newline = "\n".encode()
+        with self._lock:
+            self._appended += 1
+            
+            # line buffered output comes to us a line at a time, which we
+            # don't need to split
+            if chunk and not self.partial and \
+                    chunk.find(newline) == len(chunk) - 1:
+                self._add_line(chunk)
+                return
+            
+            lines = (self.partial + chunk).split(newline)
+            self.partial = lines.pop()
+            for line in lines: self._add_line(line + newline)
+            
+    def _drop(self, line):
+        self.size -= len(line)
+        self.dropped += len(line)
+        self.dropped_lines += 1
+            
+    def getvalue(self):
+        with self._lock:
+            if self._appended != self._value_appended:
+                self._value = "".encode().join(self._lines()) + self.partial
+                self._value_appended = self._appended
+            return self._value
+        
+    # our lines are at most "maxsize" bytes, so we don't mind keeping them
+    # and our value both
+    def close(self):
+        pass
+        
+    def view(self):
+        return memoryview(self.getvalue())
+    
+    
+# keeps the most recent lines
+class TailLinesBuffer(LinesBuffer):
+    overflow = "tail_lines"
+    
+    def __init__(self, maxsize):
+        super(TailLinesBuffer, self).__init__(maxsize)
+        self.lines = deque()
+        
+    def _add_line(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+        while self.size > self.maxsize: self._drop(self.lines.popleft())
+        
+    def _lines(self):
+        return self.lines
+        
+        
+# keeps a random sample of lines, in the order that they were written.  each
+# line gets a random key, and when the lines don't fit, the one with the
+# highest key is dropped, so which lines are kept doesn't depend on where in
+# the output they are.  our sample is a heap, with the highest key on top
+class SampleBuffer(LinesBuffer):
+    overflow = "sample"
+    
+    def __init__(self, maxsize):
+        super(SampleBuffer, self).__init__(maxsize)
+        self.sample = []
+        self.seen = 0
+        self.random = _random.Random()
+        
+    def _add_line(self, line):
+        _heapq.heappush(self.sample, (-self.random.random(), self.seen, line))
+        self.seen += 1
+        self.size += len(line)
+        while self.size > self.maxsize:
+            self._drop(_heapq.heappop(self.sample)[2])
+        
+    def _lines(self):
+        return [line for key, i, line in sorted(self.sample,
+            key=lambda item: item[1])]
+    
+    
+# this is an index of where each line ends in a stream of output, kept as an
+# array of the offsets just after each newline, so that it's 8 bytes a
+# line, instead of a string a line.  a last line without a newline ends at
+# the end of the output
+class LineIndex(object):
+    newline_re = re.compile("\n".encode())
+    
+    def __init__(self):
+        self.ends = _array.array(LINE_OFFSET_TYPE)
+        self.size = 0
+        
+    # this is for when we're indexing as we read, so the chunks are small,
+    # and usually a line each
+    def append(self, chunk):
+        find = chunk.find
+        newline = "\n".encode()
+        
+        pos = find(newline)
+        while pos != -1:
+            self.ends.append(self.size + pos + 1)
+            pos = find(newline, pos + 1)
+        self.size += len(chunk)
+        
+    # and this is for indexing all of our output at once.  data can be
+    # anything the re module can search, like bytes or an mmap
+    @classmethod
+    def from_data(cls, data):
+        index = cls()
+        index.ends = _array.array(LINE_OFFSET_TYPE,
+            (match.end() for match in cls.newline_re.finditer(data)))
+        index.size = len(data)
+        return index
+    
+    def __len__(self):
+        last = 0
+        if self.ends: last = self.ends[-1]
+        return len(self.ends) + (self.size > last)
+    
+    # the start and end offsets of line i, not including its newline
+    def span(self, i):
+        num_lines = len(self)
+        if i < 0: i += num_lines
+        if not 0 <= i < num_lines: raise IndexError("line index out of range")
+        
+        start = 0
+        if i: start = self.ends[i - 1]
+        if i < len(self.ends): return start, self.ends[i] - 1
+        return start, self.size
+    
+    
+# the lazy sequence of lines that RunningCommand.lines() gives you.  only the
+# lines you ask for are sliced out of stdout and decoded
+class LineSequence(object):
+    def __init__(self, command):
+        self.command = command
+        
+    def __len__(self):
+        return self.command.len_lines()
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            data = self.command.stdout
+            return [self.command._line(j, data)
+                for j in range(*i.indices(len(self)))]
+        return self.command.line(i)
+    
+    def __iter__(self):
+        data = self.command.stdout
+        for i in range(len(self)): yield self.command._line(i, data)
+    
+
+
+
+
 # this allows lookups to names that aren't found in the global scope to be
 # searched for as a program name.  for example, if "ls" isn't found in this
 # module's scope, we consider it a system program and try to find it.
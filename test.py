@@ -203,6 +203,19 @@ for l in "andrew":
         self.assertEqual(out, test_string.upper())
         
     
+    def test_no_stdin(self):
+        py = create_tmp_test("""
+import sys
+print(repr(sys.stdin.read()))
+""")
+        # with no input, the process should see an empty stdin, and we
+        # shouldn't be running a thread to feed it
+        p = python(py.name)
+        self.assertEqual(p.strip(), repr(""))
+        self.assertEqual(p.process.stdin, None)
+        self.assertEqual(p.process._input_thread, None)
+        
+        
     def test_manual_stdin_queue(self):
         from sh import tr
         try: from Queue import Queue, Empty
@@ -298,6 +311,17 @@ print(sh.HERP + " " + str(len(os.environ)))
         self.assertRaises(CommandNotFound, do_import)
 
 
+    def test_modules_dont_shadow_programs(self):
+        # the modules that sh imports are aliased, so that a program with
+        # the same name, like debianutils' tempfile, is still found
+        from types import ModuleType
+        for name in ("tempfile", "mmap", "array", "heapq", "hashlib",
+                "codecs", "json", "random"):
+            try: resolved = getattr(sh, name)
+            except sh.CommandNotFound: continue
+            self.assertFalse(isinstance(resolved, ModuleType), name)
+
+
     def test_command_wrapper_equivalence(self):
         from sh import Command, ls, which
         
@@ -1129,6 +1153,819 @@ else:
         self.assertEqual(len(output), 100)
         
         
+    @skipUnless(sh.HAS_READV, "only reads into a reused buffer with os.readv")
+    def test_bufferer_copies_from_read_buffer(self):
+        # our reads go into a reused buffer, so everything the bufferer hands
+        # back or holds on to has to survive that buffer being overwritten
+        for buffer_type, expected in ((0, [b"herpderp\nhe"]),
+                (1, [b"herpderp\n"]), (4, [b"herp", b"derp"])):
+            buf = bytearray(b"herpderp\nhe")
+            bufferer = sh.StreamBufferer(buffer_type=buffer_type)
+            
+            chunks = bufferer.process(memoryview(buf))
+            buf[:] = b"x" * len(buf)
+            self.assertEqual(chunks, expected)
+            
+            if buffer_type: self.assertEqual(bufferer.flush(), b"he"
+                if buffer_type == 1 else b"\nhe")
+        
+        
+    def test_internal_bytesize(self):
+        from sh import cat, BufferOverflow
+        
+        data = "".join(str(i % 10) for i in range(1000))
+        
+        output = cat(_in=data, _internal_bytesize=100)
+        self.assertEqual(output.stdout, data[-100:].encode())
+        
+        output = cat(_in=data, _internal_bytesize=100, _out_bufsize=0)
+        self.assertEqual(output.stdout, data[-100:].encode())
+        
+        output = cat(_in=data, _internal_bytesize=100, _internal_overflow="head")
+        self.assertEqual(output.stdout, data[:100].encode())
+        
+        try: cat(_in=data, _internal_bytesize=100, _internal_overflow="error")
+        except BufferOverflow as e: self.assertEqual(e.dropped, 900)
+        else: self.fail("BufferOverflow not raised")
+        
+        
+    def test_internal_spill(self):
+        from sh import cat, tr
+        
+        data = "herpderp\n" * 1000
+        
+        output = cat(_in=data, _internal_spill=1024 ** 2)
+        self.assertEqual(output.stdout, data.encode())
+        self.assertEqual(output.process._stdout.file, None)
+        
+        output = cat(_in=data, _internal_spill=100)
+        self.assertNotEqual(output.process._stdout.file, None)
+        self.assertEqual(output.process._pipe_queue, None)
+        self.assertEqual(len(output.stdout), len(data))
+        self.assertEqual(output.stdout[:], data.encode())
+        self.assertEqual(output, data)
+        
+        lines = list(output)
+        self.assertEqual(len(lines), 1000)
+        self.assertEqual(lines[0], "herpderp\n")
+        
+        piped = tr(output, "[:lower:]", "[:upper:]")
+        self.assertEqual(piped, data.upper())
+        
+        
+    def test_output_memoized(self):
+        from sh import cat
+        
+        data = "herpderp\n" * 1000
+        for kwargs in ({}, {"_internal_bytesize": 1024 ** 2},
+                {"_internal_spill": 100}):
+            p = cat(_in=data, **kwargs)
+            self.assertTrue(p.stdout is p.stdout)
+            self.assertTrue(unicode(p) is unicode(p))
+            self.assertTrue("derp" in p)
+            self.assertEqual(len(p), len(data))
+            
+        # once the process is done, the buffers don't keep their chunks and
+        # their value both
+        p = cat(_in=data)
+        p.stdout
+        self.assertEqual(list(p.process._stdout.chunks), [p.stdout])
+        p = cat(_in=data, _internal_bytesize=1024 ** 2)
+        p.stdout
+        self.assertEqual(p.process._stdout.buffer, None)
+        self.assertEqual(p.process._stdout.view(), p.stdout)
+        
+        # appending after a value has been built only adds to it
+        buf = sh.ChunkBuffer(3)
+        buf.append(b"a")
+        self.assertEqual(buf.getvalue(), b"a")
+        buf.append(b"b")
+        self.assertEqual(buf.getvalue(), b"ab")
+        buf.append(b"c")
+        buf.append(b"d")
+        self.assertEqual(buf.getvalue(), b"bcd")
+        
+        
+    def test_line_bufferer_split_lines(self):
+        data = b"".join(("line %d\n" % i).encode() for i in range(1000))
+        
+        # feed the data in awkward sizes, so that lines span chunks
+        for size in (1, 3, 7, 64, 4096):
+            bufferer = sh.StreamBufferer(buffer_type=1)
+            lines = []
+            for i in range(0, len(data), size):
+                lines.extend(bufferer.process(data[i:i+size]))
+            self.assertEqual(lines, data.splitlines(True))
+            self.assertEqual(bufferer.flush(), b"")
+            
+        bufferer = sh.StreamBufferer(buffer_type=1)
+        self.assertEqual(bufferer.process(b"no newline"), [])
+        self.assertEqual(bufferer.process(b" yet\nnext"), [b"no newline yet\n"])
+        self.assertEqual(bufferer.flush(), b"next")
+        
+        
+    def test_line_bufferer_split_character(self):
+        data = "漢字\n"
+        if not IS_PY3: data = data.decode("utf8")
+        data = data.encode("utf8")
+        
+        # a multibyte character split across two reads isn't binary
+        bufferer = sh.StreamBufferer("utf8", 1)
+        self.assertEqual(bufferer.process(data[:2]), [])
+        self.assertEqual(bufferer.process(data[2:]), [data])
+        self.assertEqual(bufferer.type, 1)
+        
+        # but invalid data is
+        bufferer = sh.StreamBufferer("utf8", 1)
+        bufferer.process(data[:2])
+        bufferer.process(b"\xff\n")
+        self.assertEqual(bufferer.type, 1024)
+        
+        
+    def test_adaptive_read_size(self):
+        py = create_tmp_test("""
+import sys
+sys.stdout.write("x" * (4 * 1024 ** 2))
+""")
+        p = python(py.name, _tty_out=False)
+        self.assertEqual(len(p.stdout), 4 * 1024 ** 2)
+        
+        reader = p.process._stdout_stream
+        self.assertTrue(reader.read_size > sh.MIN_READ_SIZE)
+        self.assertTrue(reader.read_size <= sh.MAX_READ_SIZE)
+        
+        # a few mostly empty reads shrink it back down
+        size = reader.read_size
+        for i in range(4): reader._adapt_read_size(1)
+        self.assertEqual(reader.read_size, size // 2)
+        
+        
+    def test_pipe_bytesize(self):
+        import time
+        
+        py = create_tmp_test("""
+for i in range(20000): print("herpderp" * 10)
+""")
+        maxsize = 16 * 1024
+        p = python(py.name, _iter=True, _pipe_bytesize=maxsize, _tty_out=False)
+        
+        # nothing is consuming the queue yet, so it fills up to its bound and
+        # stays there.  it can go over by at most one read, plus the line
+        # that was left over from the read before it
+        bound = maxsize + sh.MIN_READ_SIZE + len("herpderp" * 10 + "\n")
+        time.sleep(0.5)
+        queue = p.process._pipe_queue
+        self.assertTrue(queue.full())
+        self.assertTrue(queue.size <= bound, queue.size)
+        self.assertTrue(p.process.alive)
+        
+        lines = 0
+        for line in p:
+            lines += 1
+            self.assertTrue(queue.size <= bound, queue.size)
+        self.assertEqual(lines, 20000)
+
+        # in the foreground, nothing consumes the queue, so it isn't bounded
+        p = python(py.name, _pipe_bytesize=maxsize, _tty_out=False)
+        self.assertEqual(len(p.stdout), 20000 * 81)
+        self.assertEqual(p.process._pipe_queue.maxsize, None)
+        
+        
+    def test_pipe_stop(self):
+        import time
+        
+        py = create_tmp_test("""
+for i in range(20000): print("herpderp" * 10)
+""")
+        p = python(py.name, _iter=True, _pipe_bytesize=16 * 1024,
+            _pipe_stop=True)
+        time.sleep(0.5)
+        self.assertTrue(p.process._stopped)
+        
+        lines = 0
+        for line in p: lines += 1
+        self.assertEqual(lines, 20000)
+        self.assertFalse(p.process._stopped)
+        
+        
+    def test_pipe_queue_batches(self):
+        from sh import PipeQueue
+        
+        queue = PipeQueue()
+        queue.put_many([b"a\n", b"bc\n"])
+        queue.put(b"d\n")
+        self.assertEqual(queue.size, 7)
+        
+        self.assertEqual(list(queue.get_many()), [b"a\n", b"bc\n", b"d\n"])
+        self.assertEqual(queue.size, 0)
+        self.assertTrue(queue.empty())
+        self.assertRaises(sh.Empty, queue.get_many, False)
+        
+        # iterating still hands out one line at a time
+        py = create_tmp_test("""
+for i in range(1000): print(i)
+""")
+        lines = list(python(py.name, _iter=True))
+        self.assertEqual(lines, ["%d\n" % i for i in range(1000)])
+        
+        
+    def test_no_decode(self):
+        py = create_tmp_test("""
+import sys
+sys.stdout.write("herp\\nderp\\n")
+""")
+        lines = [line for line in python(py.name, _iter=True, _decode=False)]
+        self.assertEqual(lines, [b"herp\n", b"derp\n"])
+        
+        stdout = []
+        def agg(line): stdout.append(line)
+        python(py.name, _out=agg, _decode=False).wait()
+        self.assertEqual(stdout, [b"herp\n", b"derp\n"])
+        
+        # binary is still split on newlines, because we don't check for it
+        py = create_tmp_test("""
+import sys, os
+sys.stdout = os.fdopen(sys.stdout.fileno(), "wb", 0)
+sys.stdout.write(b"\\xff\\xfe\\n\\xfd")
+""")
+        lines = [line for line in python(py.name, _iter=True, _decode=False)]
+        self.assertEqual(lines, [b"\xff\xfe\n", b"\xfd"])
+        
+        
+    def test_json_format(self):
+        py = create_tmp_test("""
+import sys, json
+for i in range(5):
+    sys.stdout.write(json.dumps({"i": i, "name": "row %d" % i}) + "\\n")
+sys.stdout.write("\\n")
+sys.stdout.write("null\\n")
+""")
+        records = [r for r in python(py.name, _iter=True, _out_format="json")]
+        expected = [{"i": i, "name": "row %d" % i} for i in range(5)] + [None]
+        self.assertEqual(records, expected)
+        
+        stdout = []
+        def agg(record): stdout.append(record)
+        p = python(py.name, _out=agg, _out_format="json", _tee=True)
+        p.wait()
+        self.assertEqual(stdout, expected)
+        self.assertTrue(p.stdout.startswith(b'{"i": 0'))
+        
+        batches = [b for b in python(py.name, _iter=True, _out_format="json",
+            _iter_batch=4)]
+        self.assertTrue(all(1 <= len(b) <= 4 for b in batches))
+        self.assertEqual(sum(batches, []), expected)
+        
+        # a bad record is raised where it is in the output
+        py = create_tmp_test("""
+import sys
+sys.stdout.write('[1]\\n{bad\\n[2]\\n')
+""")
+        it = iter(python(py.name, _iter=True, _out_format="json"))
+        self.assertEqual(next(it), [1])
+        self.assertRaises(sh.RecordParseError, next, it)
+        self.assertEqual(next(it), [2])
+        
+        
+    def test_to_columns(self):
+        py = create_tmp_test("""
+import sys
+sys.stdout.write("PID SIZE NAME\\n")
+for i in range(1000):
+    sys.stdout.write("%d %d.5 proc%d\\n" % (i, i, i))
+""")
+        p = python(py.name)
+        columns = p.to_columns(header=True, dtypes={"PID": "l", "SIZE": "d"})
+        self.assertEqual(sorted(columns.keys()), ["NAME", "PID", "SIZE"])
+        self.assertEqual(list(columns["PID"]), list(range(1000)))
+        self.assertEqual(list(columns["SIZE"])[:2], [0.5, 1.5])
+        self.assertEqual(columns["NAME"][999], "proc999")
+        
+        # the last column gets the rest of the line, if lines don't all have
+        # the same number of fields
+        py = create_tmp_test("""
+import sys
+sys.stdout.write("1,a\\n2,b,c\\n3\\n")
+""")
+        columns = python(py.name).to_columns(sep=",")
+        self.assertEqual(columns, [["1", "2", "3"], ["a", "b,c", ""]])
+        
+        # and while the process runs
+        py = create_tmp_test("""
+import sys, time
+for i in range(3):
+    sys.stdout.write("%d %d\\n" % (i, i * 2))
+    sys.stdout.flush()
+    time.sleep(0.1)
+""")
+        p = python(py.name, _bg=True)
+        batches = [b for b in p.iter_columns(dtypes=["l", "l"])]
+        self.assertTrue(len(batches) > 1)
+        self.assertEqual(sum([list(b[1]) for b in batches], []), [0, 2, 4])
+        
+        # when the output doesn't go through the pipe queue, or it's already
+        # been taken off of it, we get it all in one batch once it's done
+        expected = [["0", "1", "2"], ["0", "2", "4"]]
+        p = python(py.name, _no_pipe=True, _bg=True)
+        self.assertEqual([b for b in p.iter_columns()], [expected])
+        
+        p = python(py.name, _iter=True)
+        self.assertEqual(len([line for line in p]), 3)
+        self.assertEqual([b for b in p.iter_columns()], [expected])
+        
+        lines = []
+        def agg(line): lines.append(line)
+        p = python(py.name, _out=agg, _bg=True)
+        self.assertEqual([b for b in p.iter_columns()], [[]])
+        self.assertEqual(lines, ["0 0\n", "1 2\n", "2 4\n"])
+        
+        
+    def test_stdout_view(self):
+        py = create_tmp_test("""
+import sys, os, struct
+out = os.fdopen(sys.stdout.fileno(), "wb", 0)
+out.write(struct.pack("=100i", *range(100)))
+""")
+        for kwargs in ({}, {"_internal_bytesize": 1000},
+                {"_internal_spill": 100}):
+            p = python(py.name, **kwargs)
+            view = p.stdout_view()
+            self.assertTrue(isinstance(view, memoryview))
+            self.assertEqual(view.tobytes(), p.stdout[:])
+            
+            if sh.get_numpy() or hasattr(view, "cast"):
+                self.assertEqual(list(p.stdout_array("i")), list(range(100)))
+            else: self.assertRaises(RuntimeError, p.stdout_array, "i")
+        
+        
+    def test_line_index(self):
+        py = create_tmp_test("""
+import sys
+for i in range(1000):
+    sys.stdout.write("line %d\\n" % i)
+sys.stdout.write("\\nlast")
+""")
+        for kwargs in ({}, {"_line_index": True}, {"_out_bufsize": 1024},
+                {"_line_index": True, "_out_bufsize": 1024}):
+            p = python(py.name, **kwargs)
+            expected = str(p).splitlines()
+            self.assertEqual(p.len_lines(), 1002)
+            self.assertEqual(p.line(0), "line 0")
+            self.assertEqual(p.line(1000), "")
+            self.assertEqual(p.line(-1), "last")
+            self.assertRaises(IndexError, p.line, 1002)
+            
+            lines = p.lines()
+            self.assertEqual(len(lines), len(expected))
+            self.assertEqual(lines[10:20], expected[10:20])
+            self.assertEqual(lines[::-100], expected[::-100])
+            self.assertEqual(list(lines), expected)
+            
+        # a command in the background is waited on first
+        slow = create_tmp_test("""
+import sys, time
+time.sleep(0.2)
+for i in range(5): sys.stdout.write("line %d\\n" % i)
+""")
+        p = python(slow.name, _bg=True)
+        self.assertEqual(p.line(3), "line 3")
+        self.assertEqual(p.len_lines(), 5)
+        
+        # offsets are 8 bytes, so that they can go past 4GB of output
+        if IS_PY3: self.assertEqual(sh.LineIndex().ends.itemsize, 8)
+        
+        
+    def test_digest(self):
+        import hashlib
+        py = create_tmp_test("""
+import sys
+sys.stdout.write("x" * 100000)
+sys.stderr.write("oops")
+""")
+        p = python(py.name, _out_digest="sha256", _err_digest=hashlib.md5,
+            _no_out=True)
+        self.assertEqual(p.stdout, b"")
+        self.assertEqual(p.stdout_size, 100000)
+        self.assertEqual(p.stdout_digest,
+            hashlib.sha256(b"x" * 100000).hexdigest())
+        self.assertEqual(p.stderr_size, 4)
+        self.assertEqual(p.stderr_digest, hashlib.md5(b"oops").hexdigest())
+        
+        p = python(py.name)
+        self.assertEqual(p.stdout_digest, None)
+        self.assertEqual(p.stdout_size, 100000)
+        
+        
+    def test_out_filter(self):
+        import re
+        py = create_tmp_test("""
+import sys
+for i in range(100):
+    sys.stdout.write("%s %d\\n" % ("ERROR" if i % 10 == 0 else "info", i))
+    sys.stderr.write("%d\\n" % i)
+""")
+        p = python(py.name, _out_filter="^ERROR", _err_filter=lambda l: l.startswith(b"9"))
+        self.assertEqual(p.stdout.splitlines(), [("ERROR %d" % i).encode()
+            for i in range(0, 100, 10)])
+        self.assertEqual(p.stderr, b"9\n" + b"".join(("%d\n" % i).encode()
+            for i in range(90, 100)))
+        self.assertEqual(p.stdout_size, len(str(python(py.name))))
+        
+        lines = [l for l in python(py.name, _iter=True,
+            _out_filter=re.compile(b"ERROR 5"))]
+        self.assertEqual(lines, ["ERROR 50\n"])
+        
+        
+    def test_internal_overflow_lines(self):
+        py = create_tmp_test("""
+import sys
+for i in range(1000):
+    sys.stdout.write("line %d\\n" % i)
+sys.stdout.write("end")
+sys.stdout.flush()
+sys.exit(1)
+""")
+        full = b"".join(("line %d\n" % i).encode() for i in range(1000)) + b"end"
+        
+        try: python(py.name, _internal_bytesize=100, _internal_overflow="head")
+        except sh.ErrorReturnCode_1 as e:
+            self.assertEqual(e.stdout, full[:100])
+            self.assertEqual(e.stdout_dropped, len(full) - 100)
+            self.assertTrue("%d bytes not kept" % (len(full) - 100) in str(e))
+        else: self.fail("expected ErrorReturnCode_1")
+        
+        for bufsize in (1, 100):
+            p = python(py.name, _internal_bytesize=30,
+                _internal_overflow="tail_lines", _ok_code=1,
+                _out_bufsize=bufsize)
+            # the unfinished last line is kept on top of the whole lines that
+            # fit, which is the last 3
+            self.assertEqual(p.stdout, b"line 997\nline 998\nline 999\nend")
+            self.assertEqual(p.process._stdout.dropped_lines, 997)
+        
+        p = python(py.name, _internal_bytesize=90, _internal_overflow="sample",
+            _ok_code=1)
+        lines = p.stdout.splitlines(True)
+        self.assertEqual(lines[-1], b"end")
+        self.assertTrue(len(b"".join(lines[:-1])) <= 90)
+        numbers = [int(line.split()[1]) for line in lines[:-1]]
+        self.assertEqual(numbers, sorted(numbers))
+        self.assertEqual(p.process._stdout.dropped_lines, 1000 - len(numbers))
+        
+        self.assertRaises(ValueError, python, py.name, _internal_bytesize=90,
+            _internal_overflow="middle")
+        
+        
+    def test_iter_close(self):
+        import gc, signal
+        py = create_tmp_test("""
+import sys, time
+i = 0
+while True:
+    sys.stdout.write("%d\\n" % i)
+    sys.stdout.flush()
+    i += 1
+    time.sleep(0.001)
+""")
+        p = python(py.name, _iter=True)
+        for i, line in enumerate(p):
+            if i == 10: break
+        process = p.process
+        p.close()
+        self.assertEqual(process.wait(), -signal.SIGTERM)
+        self.assertEqual([l for l in p], [])
+        
+        # it's also closed by leaving a with block, or by being garbage
+        # collected
+        with python(py.name, _iter=True, _iter_close_signal=signal.SIGKILL) as p:
+            self.assertEqual(next(p), "0\n")
+            process = p.process
+        self.assertEqual(process.wait(), -signal.SIGKILL)
+        
+        p = python(py.name, _iter=True)
+        next(p)
+        process = p.process
+        del p
+        gc.collect()
+        self.assertEqual(process.wait(), -signal.SIGTERM)
+
+        # a finished command in a reference cycle, through its callback, is
+        # collected too.  python 2 never collects a cycle with a __del__ in it
+        import weakref
+        def run_in_cycle():
+            holder = {}
+            def cb(line): holder.get("p")
+            holder["p"] = p = python("-c", "print('hi')", _out=cb)
+            p.wait()
+            return weakref.ref(p)
+        
+        ref = run_in_cycle()
+        gc.collect()
+        self.assertEqual(ref(), None)
+        self.assertEqual(gc.garbage, [])
+        
+        
+    def test_compress(self):
+        py = create_tmp_test("""
+import sys
+for i in range(10000):
+    sys.stdout.write("this is line number %d\\n" % i)
+sys.stderr.write("done")
+""")
+        expected = str(python(py.name))
+        
+        # lzma is only in python 3.3+
+        methods = ["zlib"]
+        try: import lzma
+        except ImportError: pass
+        else: methods.append("lzma")
+        
+        for method in methods:
+            p = python(py.name, _compress=method)
+            self.assertEqual(str(p), expected)
+            self.assertEqual(p.stderr, b"done")
+            self.assertEqual(p.stdout_size, len(expected))
+            self.assertTrue(p.stdout_compressed_size < len(expected) // 5)
+            self.assertEqual(p.process.stdout, expected.encode())
+        
+        self.assertEqual(python(py.name).stdout_compressed_size, None)
+        self.assertRaises(ValueError, python, py.name, _compress="rar")
+        
+        # more output after we've already decompressed it once
+        p = python(py.name, _compress="zlib", _out_bufsize=1024)
+        p.process._stdout.getvalue()
+        p.process._stdout.append(b"more")
+        self.assertEqual(p.stdout, expected.encode() + b"more")
+        
+        # getting every line only decompresses stdout once
+        p = python(py.name, _compress="zlib")
+        decompressed = []
+        getvalue = p.process._stdout.getvalue
+        def counted_getvalue():
+            decompressed.append(1)
+            return getvalue()
+        p.process._stdout.getvalue = counted_getvalue
+        self.assertEqual(list(p.lines()), expected.splitlines())
+        self.assertEqual(len(decompressed), 2)
+        
+        
+    def test_out_fan_out(self):
+        py = create_tmp_test("""
+import sys
+for i in range(100):
+    sys.stdout.write("line %d\\n" % i)
+""")
+        expected = str(python(py.name))
+        
+        if IS_PY3: from io import BytesIO as cStringIO
+        else: from cStringIO import StringIO as cStringIO
+        
+        path = tempfile.mktemp()
+        buf = cStringIO()
+        lines = []
+        def agg(line): lines.append(line)
+        def bad(line):
+            if line == "line 10\n": raise ValueError("nope")
+        
+        with open(path + ".fd", "wb") as f:
+            f.write(b"before\n")
+            p = python(py.name, _out=[path, agg, bad, buf, f])
+            p.wait()
+        
+        with open(path, "rb") as f: self.assertEqual(f.read(), expected.encode())
+        with open(path + ".fd", "rb") as f:
+            self.assertEqual(f.read(), b"before\n" + expected.encode())
+        self.assertEqual("".join(lines), expected)
+        self.assertEqual(buf.getvalue(), expected.encode())
+        
+        self.assertEqual(len(p.sink_errors), 1)
+        target, exc = p.sink_errors[0]
+        self.assertTrue(target is bad)
+        self.assertTrue(isinstance(exc, ValueError))
+        
+        # and with _tee, to a downstream process too
+        lines = []
+        p = python(py.name, _out=[agg], _tee=True, _piped=True)
+        self.assertEqual(int(sh.wc(p, "-l")), 100)
+        self.assertEqual("".join(lines), expected)
+        os.remove(path)
+        os.remove(path + ".fd")
+        
+        # files whose write() changes what's written don't get os.write
+        import gzip
+        with gzip.open(path, "wb") as f: python(py.name, _out=f)
+        with gzip.open(path, "rb") as f:
+            self.assertEqual(f.read(), expected.encode())
+        os.remove(path)
+        
+        # a callback in a list can still write to stdin
+        stdins = []
+        def with_stdin(line, stdin): stdins.append(stdin)
+        python(py.name, _out=[with_stdin]).wait()
+        self.assertTrue(isinstance(stdins[0], sh.Queue))
+        
+        
+    @skipUnless(sh.HAS_SHARED_MEMORY, "needs multiprocessing.shared_memory")
+    def test_shared_ring(self):
+        import threading
+        py = create_tmp_test("""
+import sys
+for i in range(1000):
+    sys.stdout.write("line %d\\n" % i)
+""")
+        # small enough that the writer has to wait for the readers, and
+        # records wrap around the end of the ring
+        ring = sh.SharedRingWriter(capacity=100)
+        lock = threading.Lock()
+        results = [[], []]
+        
+        def read(records):
+            reader = sh.SharedRingReader(ring.name, lock=lock)
+            for record in reader: records.append(record)
+            reader.close()
+        
+        threads = [threading.Thread(target=read, args=(r,)) for r in results]
+        for thread in threads: thread.start()
+        
+        with ring: python(py.name, _out=ring)
+        for thread in threads: thread.join()
+        ring.unlink()
+        
+        records = sorted(results[0] + results[1],
+            key=lambda r: int(r.split()[1]))
+        self.assertEqual(records,
+            [("line %d\n" % i).encode() for i in range(1000)])
+        
+        # a line that's bigger than the ring is dropped, and the rest still
+        # make it through
+        big = create_tmp_test("""
+import sys
+sys.stdout.write("x" * 200 + "\\n")
+sys.stdout.write("small\\n")
+""")
+        ring = sh.SharedRingWriter(capacity=100, timeout=0.5)
+        reader = sh.SharedRingReader(ring.name)
+        with ring: python(big.name, _out=ring)
+        self.assertEqual(ring.dropped, 1)
+        self.assertEqual([r for r in reader], [b"small\n"])
+        reader.close()
+        ring.unlink()
+
+        # with nobody reading, the writer gives up after its timeout, instead
+        # of holding up the process forever
+        ring = sh.SharedRingWriter(capacity=100, timeout=0.1)
+        with ring: python(py.name, _out=ring)
+        self.assertTrue(ring.closed)
+        self.assertTrue(ring.dropped > 900)
+        ring.unlink()
+        
+        # or when it's closed while it waits
+        ring = sh.SharedRingWriter(capacity=100)
+        timer = threading.Timer(0.1, ring.close)
+        timer.start()
+        python(py.name, _out=ring)
+        timer.join()
+        self.assertTrue(ring.dropped > 900)
+        reader = sh.SharedRingReader(ring.name)
+        records = list(iter(reader.read, None))
+        self.assertEqual(records[-1], b"line 8\n")
+        reader.close()
+        ring.unlink()
+        
+        # a lock shared with the readers
+        ring = sh.SharedRingWriter(capacity=100, lock=lock)
+        reader = sh.SharedRingReader(ring.name, lock=lock)
+        ring.write(b"hello")
+        ring.close()
+        self.assertEqual([r for r in reader], [b"hello"])
+        reader.close()
+        ring.unlink()
+
+
+    def test_map(self):
+        import threading
+        import time
+        py = create_tmp_test("""
+import sys, time
+n = int(sys.argv[1])
+time.sleep(n / 20.0)
+sys.stdout.write(str(n))
+exit(n == 2)
+""")
+        script = python.bake(py.name)
+        threads = threading.active_count()
+
+        results = list(script.map([3, 2, 1, 0], concurrency=4))
+        self.assertEqual([r.stdout for r in (results[0], results[2], results[3])],
+            [b"3", b"1", b"0"])
+        self.assertTrue(isinstance(results[1], sh.ErrorReturnCode_1))
+
+        # they finish shortest first
+        results = script.map([3, 1, 0], concurrency=4, ordered=False)
+        self.assertEqual([r.stdout for r in results], [b"0", b"1", b"3"])
+
+        # with a concurrency of 1, they run one after the other
+        results = script.map([1, 0], concurrency=1, ordered=False)
+        self.assertEqual([r.stdout for r in results], [b"1", b"0"])
+
+        # an _out callback that raises fails its own command, and doesn't
+        # hang the others
+        def bad_out(chunk):
+            if chunk == "2": raise RuntimeError("bad chunk")
+        results = list(script.map([3, 2, 1], concurrency=3, _ok_code=[0, 1],
+            _out=bad_out))
+        self.assertEqual([type(r) for r in results],
+            [sh.RunningCommand, RuntimeError, sh.RunningCommand])
+
+        self.assertRaises(TypeError, list, script.map([1], _bg=True))
+
+        # the IOEngine thread goes away once we're done
+        sleep_time = 0
+        while threading.active_count() > threads and sleep_time < 1:
+            time.sleep(0.01)
+            sleep_time += 0.01
+        self.assertEqual(threading.active_count(), threads)
+
+
+    def test_map_shards(self):
+        py = create_tmp_test("""
+import sys
+lines = sys.stdin.readlines()
+# every shard should be whole lines
+assert all(line.endswith("\\n") for line in lines)
+sys.stdout.write("".join(line.upper() for line in lines))
+""")
+        data = "".join("line %d\n" % i for i in range(1000))
+        source = create_tmp_test(data)
+        script = python.bake(py.name, _tty_out=False)
+
+        results = list(script.map_shards(source.name, shard_size=1000,
+            concurrency=3))
+        self.assertTrue(len(results) > 5)
+        self.assertEqual("".join(str(r) for r in results), data.upper())
+
+        # by default, there's a shard for each process we run at once
+        results = list(script.map_shards(source.name, concurrency=3))
+        self.assertEqual(len(results), 3)
+
+        with open(source.name, "rb") as stream:
+            results = script.map_shards(stream, shard_size=1000, ordered=False)
+            lines = "".join(str(r) for r in results).splitlines(True)
+        self.assertEqual(sorted(lines), sorted(data.upper().splitlines(True)))
+
+
+    def test_delimiter_buffering(self):
+        py = create_tmp_test("""
+import sys
+sys.stdout.write("herp\\0derp\\0last")
+""")
+        records = [r for r in python(py.name, _iter=True, _out_bufsize="\0")]
+        self.assertEqual(records, ["herp\0", "derp\0", "last"])
+        
+        stdout = []
+        def agg(record): stdout.append(record)
+        python(py.name, _out=agg, _out_bufsize="\0").wait()
+        self.assertEqual(stdout, ["herp\0", "derp\0", "last"])
+        
+        # a delimiter that is split between reads
+        data = b"one<>two<>three<>"
+        for size in (1, 2, 3, 5):
+            bufferer = sh.StreamBufferer(buffer_type="<>")
+            records = []
+            for i in range(0, len(data), size):
+                records.extend(bufferer.process(data[i:i+size]))
+            self.assertEqual(records, [b"one<>", b"two<>", b"three<>"])
+            
+            
+    def test_length_prefixed_buffering(self):
+        import struct
+        from sh import LengthPrefixed
+        
+        framing = LengthPrefixed(">H")
+        payloads = [b"herp", b"", b"derp\n" * 100]
+        data = b"".join(struct.pack(">H", len(p)) + p for p in payloads)
+        
+        for size in (1, 3, 7, len(data)):
+            bufferer = sh.StreamBufferer(buffer_type=framing)
+            records = []
+            for i in range(0, len(data), size):
+                # we're only handed views of a read buffer with os.readv
+                chunk = data[i:i+size]
+                if sh.HAS_READV: chunk = memoryview(chunk)
+                records.extend(bufferer.process(chunk))
+            self.assertEqual([framing.payload(r) for r in records], payloads)
+            self.assertEqual(b"".join(records), data)
+            
+        py = create_tmp_test("""
+import sys, os, struct
+out = os.fdopen(sys.stdout.fileno(), "wb", 0)
+for payload in (b"herp", b"derp"): out.write(struct.pack(">I", 4) + payload)
+""")
+        p = python(py.name, _iter=True, _decode=False,
+            _out_bufsize=LengthPrefixed())
+        self.assertEqual([r for r in p], [b"\0\0\0\x04herp", b"\0\0\0\x04derp"])
+        
+        
     def test_change_stdout_buffering(self):
         py = create_tmp_test("""
 import sys